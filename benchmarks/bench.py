@@ -0,0 +1,263 @@
+"""
+Render pipeline benchmarks
+
+Every case runs in a fresh process (so peak RSS belongs to the case) on synthetic templates and the bundled fonts.
+Measurement caches are cleared before every iteration: the numbers are the cost of a new poster.
+
+Run:
+    python -m benchmarks.bench
+    python -m benchmarks.bench --update-baseline
+"""
+
+import json
+import os
+import resource
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from multiprocessing import get_context
+from os.path import dirname, join
+from random import Random
+from tempfile import gettempdir, mkdtemp
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+BASELINE = join(dirname(__file__), "baseline.json")
+
+_WORDS = (
+    "свобода слово право закон гражданин общество власть город народ правда мир голос выбор время будущее "
+    "и в на с к о от из за по до для без под над при про через перед между среди а но или если чтобы хотя"
+).split()
+
+TEXT_LENGTHS = {"word": 1, "short": 40, "medium": 200, "long": 1000}
+BACKGROUND_SIZES = {"vga": (640, 480), "fhd": (1920, 1080), "12mp": (4000, 3000), "40mp": (7296, 5472)}
+
+
+def quote(length: int) -> str:
+    """
+    Deterministic quote of about LENGTH characters (a single word for LENGTH=1)
+    """
+    random = Random(length)
+    words = [random.choice(_WORDS[:15])]
+    while len(" ".join(words)) < length:
+        words.append(random.choice(_WORDS))
+    return " ".join(words)
+
+
+def background(size: Tuple[int, int]) -> bytes:
+    """
+    Deterministic JPEG photo-like background (generated once, so it does not count in the peak RSS of cases)
+    """
+    path = join(gettempdir(), "quote-bot-bench", f"background-{size[0]}x{size[1]}.jpg")
+    if not os.path.isfile(path):
+        os.makedirs(dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(_generate_background(size))
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def _generate_background(size: Tuple[int, int]) -> bytes:
+    from PIL import Image, ImageDraw
+
+    image = Image.linear_gradient("L").resize(size).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    random = Random(size[0])
+    for _ in range(200):
+        x, y = random.randrange(size[0]), random.randrange(size[1])
+        radius = random.randrange(10, max(size) // 10)
+        draw.ellipse((x, y, x + radius, y + radius), fill=tuple(random.randrange(256) for _ in range(3)))
+    with BytesIO() as output:
+        image.save(output, format="JPEG", quality=90)
+        return output.getvalue()
+
+
+def _setup():
+    """
+    Synthetic black and white templates (transparent poster with a logo and a frame) and no bundle
+    """
+    from PIL import Image, ImageDraw
+
+    path = mkdtemp(prefix="quote-bot-bench-")
+    os.environ["BUNDLE_DIR"] = join(path, "bundle")
+    for name, color in (("black", (255, 255, 255, 255)), ("white", (0, 0, 0, 255))):
+        image = Image.new("RGBA", (1920, 1080), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((20, 20, 1900, 1060), outline=color, width=8)
+        draw.ellipse((1700, 860, 1880, 1040), fill=color)
+        image.save(join(path, f"{name}.png"))
+
+    from quote_bot.templates import templates
+
+    templates.TemplatesManager._path_to_templates = path
+
+
+def _clear_caches():
+    from quote_bot.optimizator import measurement_cache
+    from quote_bot.optimizator.layout import font_metrics
+
+    measurement_cache.clear()
+    font_metrics.cache_clear()
+
+
+def _case(name: str) -> Callable[[], None]:
+    """
+    Prepare benchmark case
+    :param name: case name, see cases()
+    :return: function to measure
+    """
+    kind, *args = name.split(":")
+
+    if kind == "text":
+        from quote_bot.textmanager import process
+
+        text = quote(TEXT_LENGTHS[args[0]])
+        return lambda: process(text)
+
+    if kind == "layout":
+        from quote_bot.optimizator import optimize_font_size
+        from quote_bot.settings import DesignerSettings
+
+        text = quote(TEXT_LENGTHS[args[0]])
+        return lambda: optimize_font_size(1560, 740, text, DesignerSettings.path_to_font(), 150)
+
+    if kind == "background":
+        from PIL import Image
+
+        from quote_bot.designer import add_background_on_image, open_background
+
+        template = Image.new("RGBA", (1920, 1080), (0, 0, 0, 0))
+        content = background(BACKGROUND_SIZES[args[1]])
+        if args[0] == "decode":
+            return lambda: open_background(BytesIO(content), template.size)
+        image = Image.open(BytesIO(content))
+        image.load()
+        return lambda: add_background_on_image(template, image)
+
+    if kind == "poster":
+        from quote_bot.templates import TemplatesManager
+
+        manager = TemplatesManager(cache_renders=False)
+        text = quote(TEXT_LENGTHS[args[0]]) + (" @ Автор Цитаты" if args[1] == "caption" else "")
+        content = background(BACKGROUND_SIZES[args[2]]) if args[2] != "none" else None
+        return lambda: manager.process_template(
+            "black", text, BytesIO(content) if content else None, profile="document"
+        )
+
+    raise ValueError(f"Unknown benchmark {name}")
+
+
+def cases() -> List[str]:
+    names = [f"text:{length}" for length in TEXT_LENGTHS]
+    names += [f"layout:{length}" for length in TEXT_LENGTHS]
+    names += [f"background:{stage}:{size}" for stage in ("decode", "composite") for size in BACKGROUND_SIZES]
+    names += [f"poster:{length}:{caption}:none" for length in TEXT_LENGTHS for caption in ("plain", "caption")]
+    names += [f"poster:medium:caption:{size}" for size in ("fhd", "40mp")]
+    return names
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))]
+
+
+def run_case(name: str, iterations: int) -> Dict[str, float]:
+    """
+    Run benchmark case (in a fresh process, see main)
+    :return: p50 and p99 latency in ms, peak RSS in MB, optimizer probes per iteration
+    """
+    _setup()
+    from quote_bot import metrics
+
+    func = _case(name)
+    _clear_caches()
+    func()  # Warm up: imports and fonts
+
+    timings = []
+    probes = 0
+    for _ in range(iterations):
+        _clear_caches()
+        with metrics.collect() as trace:
+            start = perf_counter()
+            func()
+            timings.append(perf_counter() - start)
+        probes += trace.counters.get("optimizer_probes", 0) + trace.counters.get("optimizer_checks", 0)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "p50_ms": round(_percentile(timings, 0.5) * 1000, 2),
+        "p99_ms": round(_percentile(timings, 0.99) * 1000, 2),
+        "peak_rss_mb": round(rss / 1024 if sys.platform != "darwin" else rss / 1024 / 1024, 1),
+        "probes": probes / iterations,
+    }
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> List[str]:
+    """
+    Find regressions
+    :param threshold: allowed relative slowdown of p50 and growth of peak RSS, e.g. 0.2
+    :return: regression descriptions
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in ("p50_ms", "peak_rss_mb"):
+            if result[metric] > base[metric] * (1 + threshold):
+                regressions.append(f"{name}: {metric} {base[metric]} -> {result[metric]}")
+        if result["probes"] > base["probes"]:
+            regressions.append(f"{name}: probes {base['probes']} -> {result['probes']}")
+    return regressions
+
+
+def _format_row(name: str, result: Dict[str, float], base: Optional[Dict[str, float]]) -> str:
+    change = f"{(result['p50_ms'] / base['p50_ms'] - 1) * 100:+.0f}%" if base and base["p50_ms"] else ""
+    return (
+        f"{name:<32} {result['p50_ms']:>10.2f} {result['p99_ms']:>10.2f} {result['peak_rss_mb']:>10.1f} "
+        f"{result['probes']:>8.1f} {change:>8}"
+    )
+
+
+def main():
+    parser = ArgumentParser(description="Render pipeline benchmarks")
+    parser.add_argument("-k", "--filter", default="", help="run cases containing this substring")
+    parser.add_argument("-n", "--iterations", type=int, default=20)
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file")
+    parser.add_argument("--update-baseline", action="store_true", help="save results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 = 20%%")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    print(f"{'case':<32} {'p50 ms':>10} {'p99 ms':>10} {'RSS MB':>10} {'probes':>8} {'p50 Δ':>8}")
+    # Backgrounds are generated in a separate process too: children inherit the peak RSS of the parent
+    with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+        list(executor.map(background, BACKGROUND_SIZES.values()))
+
+    results = {}
+    for name in cases():
+        if args.filter not in name:
+            continue
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+            results[name] = executor.submit(run_case, name, args.iterations).result()
+        print(_format_row(name, results[name], baseline.get(name)), flush=True)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump({**baseline, **results}, file, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print("\nRegressions:\n" + "\n".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,10 @@ docker build -t aws .
 id=$(docker create aws:latest)
 docker cp $id:/app/aws.zip aws-layer.zip
 
+# Build templates bundle (decoded templates, previews and font metrics)
+rm -rf quote_bot/bundle
+poetry run python -m quote_bot.bundle
+
 # Build lambda
 rm -rf aws
 rm aws.zip
@@ -1,4 +1,4 @@
-from quote_bot.main import lambda_handler
+from quote_bot.main import lambda_handler, worker_handler
 
 
-__all__ = ["lambda_handler"]  # for flake8
+__all__ = ["lambda_handler", "worker_handler"]  # for flake8
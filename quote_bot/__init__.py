@@ -1,3 +1,3 @@
-from .main import lambda_handler, main
+from .main import lambda_handler, main, worker_handler, worker_main
 
-__all__ = ["main", "lambda_handler"]
+__all__ = ["main", "lambda_handler", "worker_main", "worker_handler"]
@@ -1,13 +1,21 @@
+import logging
+from asyncio import Task, ensure_future, wait
 from enum import IntEnum
+from functools import partial
+from time import monotonic, time
+from typing import Dict, Optional, Set, Tuple
 
 import aiogram.types as types
-from aiocache import cached
-from aiogram import Bot
+from aiogram import Bot, Dispatcher
 from aiogram.dispatcher.handler import CancelHandler, current_handler
 from aiogram.dispatcher.middlewares import BaseMiddleware
 
+from quote_bot.cache import BoundedCache
+from quote_bot.dynamo import set_service_data
 from quote_bot.settings import BotSettings
 
+logger = logging.getLogger(__name__)
+
 
 class Privileges(IntEnum):
     nothing = 0
@@ -41,16 +49,131 @@ def public():
     return decorator
 
 
-@cached(ttl=BotSettings.access_cache_ttl())
-async def _get_privileges(user_id: int, chat_id: int) -> Privileges:
+class PrivilegesCache:
     """
-    Check user access
-    :param user_id: user id
-    :param chat_id: access chat id
-    :return: privileges
+    Two-tier cache of user privileges: short-lived in-process LRU and the dispatcher storage
+    (DynamoDB on AWS Lambda, shared by all containers), so privileges survive cold starts.
+    Membership events of the access chat are the source of truth: they are kept for ACCESS_EVENT_TTL
+    and make every process drop its memory tier entry within ACCESS_MEMORY_TTL.
+    Users the events did not tell about are checked with get_chat_member: members are trusted for ACCESS_CACHE_TTL
+    (then served stale while checked again in the background, until ACCESS_STALE_TTL),
+    strangers are checked again after ACCESS_NEGATIVE_CACHE_TTL
     """
-    bot = Bot.get_current()
-    chat_member = await bot.get_chat_member(chat_id, user_id)
+
+    _chat = 0  # Service address in the storage: chat 0, user = user id
+
+    def __init__(self, access_chat_id: int):
+        """
+        :param access_chat_id: access chat id
+        """
+        self._access_chat_id = access_chat_id
+        self._ttl = BotSettings.access_cache_ttl()
+        self._event_ttl = BotSettings.access_event_ttl()
+        self._negative_ttl = BotSettings.access_negative_cache_ttl()
+        self._stale_ttl = BotSettings.access_stale_ttl()
+        self._memory = BoundedCache(BotSettings.access_cache_size(), ttl=BotSettings.access_memory_ttl())
+        self._refreshing: Dict[int, Task] = dict()
+        self._admins: Optional[Tuple[Set[int], float]] = None  # Administrator ids and load time
+
+    async def _fetch(self, user_id: int) -> Privileges:
+        """
+        Check user access in Telegram
+        """
+        bot = Bot.get_current()
+        return _member_privileges(await bot.get_chat_member(self._access_chat_id, user_id))
+
+    async def _load(self, user_id: int) -> Optional[Tuple[Privileges, int, bool]]:
+        entry = self._memory.get(user_id)
+        if entry is None:
+            storage = Dispatcher.get_current().storage
+            data = await storage.get_data(chat=self._chat, user=user_id)
+            if "privileges" in data:
+                entry = Privileges(int(data["privileges"])), int(data["checked"]), bool(data.get("event"))
+                self._memory.set(user_id, entry)
+        return entry
+
+    async def set(self, user_id: int, privileges: Privileges, event: bool = False):
+        """
+        Save known user privileges to both tiers
+        :param event: privileges are known from a membership event of the access chat
+        """
+        checked = int(time())
+        self._memory.set(user_id, (privileges, checked, event))
+        storage = Dispatcher.get_current().storage
+        data = {"privileges": int(privileges), "checked": checked, "event": event}
+        # The entry is of no use after it goes stale: it is checked in Telegram again anyway
+        ttl = self._event_ttl if event else self._stale_ttl
+        await set_service_data(storage, self._chat, user_id, data, ttl)
+
+    async def refresh(self, user_id: int) -> Privileges:
+        """
+        Check user access in Telegram and save the result to both tiers
+        """
+        privileges = await self._fetch(user_id)
+        await self.set(user_id, privileges)
+        return privileges
+
+    async def is_admin(self, user_id: int) -> bool:
+        """
+        Check if the user is an administrator of the access chat.
+        Administrators are loaded in one request on the first check and kept in memory for ACCESS_ADMINS_TTL
+        """
+        if self._admins is None or monotonic() - self._admins[1] > BotSettings.access_admins_ttl():
+            bot = Bot.get_current()
+            admins = await bot.get_chat_administrators(self._access_chat_id)
+            self._admins = {admin.user.id for admin in admins}, monotonic()
+        return user_id in self._admins[0]
+
+    def forget_admins(self):
+        """
+        Load administrators again on the next check
+        """
+        self._admins = None
+
+    async def get(self, user_id: int) -> Privileges:
+        """
+        Get user privileges
+        :param user_id: user id
+        """
+        entry = await self._load(user_id)
+        if entry is None:
+            return await self.refresh(user_id)
+
+        privileges, checked, event = entry
+        age = time() - checked
+        if event:
+            ttl = self._event_ttl
+        else:
+            ttl = self._ttl if privileges > Privileges.nothing else self._negative_ttl
+        if age < ttl:
+            return privileges
+        if privileges == Privileges.nothing or age >= self._stale_ttl:
+            return await self.refresh(user_id)
+
+        if user_id not in self._refreshing:
+            task = ensure_future(self.refresh(user_id))
+            task.add_done_callback(partial(self._refreshed, user_id))
+            self._refreshing[user_id] = task
+        return privileges
+
+    def _refreshed(self, user_id: int, task: Task):
+        """
+        Background check of the user is over (whether or not the update was processed to the end)
+        """
+        self._refreshing.pop(user_id, None)
+        if not task.cancelled() and task.exception() is not None:  # Stale privileges are used until the next check
+            logger.error("Privileges refresh failed", exc_info=task.exception())
+
+    async def wait_refresh(self, user_id: int):
+        """
+        Wait for the background check of the user (so its result is saved with the rest of the update)
+        """
+        task = self._refreshing.get(user_id)
+        if task is not None:
+            await wait([task])  # Errors are logged by _refreshed
+
+
+def _member_privileges(chat_member: types.ChatMember) -> Privileges:
     if chat_member.is_chat_admin():
         return Privileges.admin
     if chat_member.is_chat_member():
@@ -59,10 +182,66 @@ async def _get_privileges(user_id: int, chat_id: int) -> Privileges:
 
 
 class AccessMiddleware(BaseMiddleware):
+    """
+    Allow the bot only to members of the access chat.
+    Privileges are kept in a membership index: joined and left members are updated from the access chat events,
+    other users are checked on the first message
+    """
+
     def __init__(self, access_chat_id: int):
         self._access_chat_id = access_chat_id
+        self._privileges = PrivilegesCache(access_chat_id)
         super(AccessMiddleware, self).__init__()
 
+    def register_handlers(self, dp: Dispatcher):
+        """
+        Register handlers of the access chat events that keep the membership index up to date
+        """
+        dp.register_message_handler(
+            self.process_members, content_types=[types.ContentType.NEW_CHAT_MEMBERS, types.ContentType.LEFT_CHAT_MEMBER]
+        )
+        dp.register_chat_member_handler(self.process_chat_member)
+        dp.register_my_chat_member_handler(self.process_my_chat_member)
+
+    @public()
+    async def process_members(self, message: types.Message):
+        """
+        Members joined or left the access chat (service message)
+        """
+        if message.chat.id != self._access_chat_id:
+            return
+        for user in message.new_chat_members or ():
+            if not user.is_bot:
+                await self._privileges.set(user.id, Privileges.user, event=True)
+        if message.left_chat_member and not message.left_chat_member.is_bot:
+            await self._privileges.set(message.left_chat_member.id, Privileges.nothing, event=True)
+
+    async def process_chat_member(self, chat_member_updated: types.ChatMemberUpdated):
+        """
+        Member status in the access chat was changed (chat_member update, sent if the bot is an administrator).
+        Unlike service messages, it is sent for members who leave large groups without a message too
+        """
+        if chat_member_updated.chat.id != self._access_chat_id:
+            return
+        member = chat_member_updated.new_chat_member
+        if member.user.is_bot:
+            return
+        await self._privileges.set(member.user.id, _member_privileges(member), event=True)
+        if member.is_chat_admin() or chat_member_updated.old_chat_member.is_chat_admin():
+            self._privileges.forget_admins()
+
+    async def process_my_chat_member(self, chat_member_updated: types.ChatMemberUpdated):
+        """
+        Bot status in the access chat was changed (my_chat_member update)
+        """
+        if chat_member_updated.chat.id != self._access_chat_id:
+            return
+        if not chat_member_updated.new_chat_member.is_chat_admin():
+            logger.warning(
+                "The bot is not an administrator of the access chat: "
+                "members who leave it without a service message keep access until they are checked again"
+            )
+
     @classmethod
     def _is_root_command(cls) -> bool:
         handler = current_handler.get()
@@ -81,12 +260,16 @@ class AccessMiddleware(BaseMiddleware):
             await message.answer("Для общения с ботом используйте личные сообщения")
             raise CancelHandler()
 
-        privileges = await _get_privileges(message.from_user.id, self._access_chat_id)
+        privileges = await self._privileges.get(message.from_user.id)
 
         if privileges < Privileges.user:
             await message.answer("Вы должны быть участником тематического чата для доступа к Конструктору Плакатов")
             raise CancelHandler()
 
-        if self._is_root_command() and privileges < Privileges.admin:
+        if self._is_root_command() and not await self._privileges.is_admin(message.from_user.id):
             await message.answer("Вы должны быть администратором чата для доступа к этому функционалу")
             raise CancelHandler()
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        if message.from_user:
+            await self._privileges.wait_refresh(message.from_user.id)
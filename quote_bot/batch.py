@@ -0,0 +1,203 @@
+"""
+Render many posters at once, without Telegram
+
+Input is a CSV (with a header) or JSONL file with rows:
+    template, text, author (optional), background (optional path to image), name (optional file name, no directories)
+
+Usage:
+    poetry run render-batch posters.csv -o posters/
+    poetry run render-batch posters.jsonl -o posters.zip -j 8
+
+Posters already present in the output are skipped, so an interrupted batch is resumed by running it again
+"""
+
+import csv
+import json
+import sys
+from argparse import ArgumentParser
+from hashlib import sha256
+from io import BytesIO
+from multiprocessing import Pool
+from os import listdir, makedirs, replace
+from os.path import basename, dirname, exists, isabs
+from os.path import join as join_path
+from shutil import rmtree
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from zipfile import ZIP_STORED, ZipFile
+
+_templates_manager = None
+
+
+def read_rows(path: str) -> List[Dict[str, str]]:
+    """
+    Read batch file
+    :param path: .csv or .jsonl file
+    """
+    with open(path, encoding="utf-8") as file:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(file))
+        else:
+            rows = [json.loads(line) for line in file if line.strip()]
+
+    base = dirname(path)
+    for number, row in enumerate(rows, start=1):
+        if not row.get("template") or not row.get("text"):
+            raise ValueError(f"Row {number}: template and text are required")
+        background = row.get("background")
+        if background and not isabs(background):
+            row["background"] = join_path(base, background)  # Relative to the batch file
+        row.setdefault("name", "")
+        if not row["name"]:
+            digest = sha256(json.dumps(row, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+            row["name"] = f"{number:05d}-{row['template']}-{digest[:8]}.png"
+        name = row["name"]
+        # Posters are written into the output directory or zip only: "../x.png" or "/tmp/x.png" would escape it
+        if name != basename(name) or "\\" in name or name in (".", ".."):
+            raise ValueError(f"Row {number}: name must be a file name without directories, got {name!r}")
+    return rows
+
+
+def _init_worker():
+    """
+    Load templates and fonts once per worker process
+    """
+    global _templates_manager
+    from quote_bot.templates import TemplatesManager
+
+    _templates_manager = TemplatesManager(cache_renders=False)
+
+
+def _render(task: Tuple[Dict[str, str], str, Optional[int]]) -> Tuple[str, Optional[bytes], Optional[str]]:
+    """
+    Render one poster in a worker process
+    :return: Tuple[file name, image or None, error or None]
+    """
+    row, profile, width = task
+    text = row["text"] + (f" @ {row['author']}" if row.get("author") else "")
+    try:
+        background = None
+        if row.get("background"):
+            with open(row["background"], "rb") as file:
+                background = BytesIO(file.read())
+        image = _templates_manager.process_template(row["template"], text, background, profile=profile, width=width)
+    except Exception as error:  # One bad row does not stop the batch
+        return row["name"], None, f"{type(error).__name__}: {error}"
+    return row["name"], image, None
+
+
+class _Output:
+    """
+    Directory or zip archive with rendered posters
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._archive: Optional[str] = None
+        self._packed: Set[str] = set()
+        if path.endswith(".zip"):
+            # Posters are written to a directory next to the archive and packed when the batch is over:
+            # a killed batch leaves them there to be resumed, the archive is never left half-written
+            self._archive = path
+            self._path = f"{path}.parts"
+            if exists(path):
+                with ZipFile(path) as archive:
+                    self._packed = set(archive.namelist())
+        makedirs(self._path, exist_ok=True)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._packed or exists(join_path(self._path, name))
+
+    def write(self, name: str, image: bytes):
+        path = join_path(self._path, name)
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(image)
+        replace(f"{path}.tmp", path)  # Half-written posters are never taken for done ones
+
+    def close(self):
+        """
+        Pack posters into the archive (with the posters it had already) and replace it at once
+        """
+        if not self._archive:
+            return
+        with ZipFile(f"{self._archive}.tmp", "w", ZIP_STORED) as archive:  # PNG is compressed already
+            if self._packed:
+                with ZipFile(self._archive) as packed:
+                    for info in packed.infolist():
+                        archive.writestr(info, packed.read(info))
+            for name in sorted(listdir(self._path)):
+                if not name.endswith(".tmp") and name not in self._packed:
+                    archive.write(join_path(self._path, name), name)
+        replace(f"{self._archive}.tmp", self._archive)
+        rmtree(self._path)
+
+
+def render_batch(
+    rows: List[Dict[str, str]],
+    output: str,
+    jobs: Optional[int] = None,
+    profile: str = "document",
+    width: Optional[int] = None,
+    progress: Optional[Callable[[int, int, str, Optional[str]], None]] = None,
+) -> Tuple[int, int, int]:
+    """
+    Render posters in a process pool and save them as they are ready
+    :param rows: rows of the batch file, see read_rows
+    :param output: directory or .zip file
+    :param jobs: number of worker processes (CPU count by default)
+    :param profile: output profile, see designer.OUTPUT_PROFILES
+    :param width: poster width (None for the template size)
+    :param progress: called after every poster with (done, total, file name, error or None)
+    :return: Tuple[rendered, failed, skipped (already in the output)]
+    """
+    writer = _Output(output)
+    rendered = failed = 0
+    try:
+        tasks = [(row, profile, width) for row in rows if row["name"] not in writer]
+        with Pool(jobs, initializer=_init_worker) as pool:
+            for name, image, error in pool.imap_unordered(_render, tasks):
+                if image is not None:
+                    writer.write(name, image)
+                    rendered += 1
+                else:
+                    failed += 1
+                if progress:
+                    progress(rendered + failed, len(tasks), name, error)
+    finally:
+        writer.close()
+    return rendered, failed, len(rows) - len(tasks)
+
+
+def main():
+    from quote_bot.designer import OUTPUT_PROFILES
+
+    parser = ArgumentParser(prog="render-batch", description="Render posters from a CSV or JSONL file")
+    parser.add_argument("input", help=".csv or .jsonl file: template, text, author, background, name")
+    parser.add_argument("-o", "--output", default="posters", help="output directory or .zip file")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (CPU count by default)")
+    parser.add_argument("--profile", default="document", choices=list(OUTPUT_PROFILES), help="output profile")
+    parser.add_argument("--width", type=int, default=None, help="poster width (template size by default)")
+    args = parser.parse_args()
+
+    start = perf_counter()
+
+    def progress(done: int, total: int, name: str, error: Optional[str]):
+        if error:
+            print(f"\n{name}: {error}", file=sys.stderr)
+        rate = done / (perf_counter() - start)
+        print(f"\r{done}/{total} posters, {rate:.1f} posters/s", end="", file=sys.stderr)
+
+    rendered, failed, skipped = render_batch(
+        read_rows(args.input), args.output, args.jobs, args.profile, args.width, progress
+    )
+    elapsed = perf_counter() - start
+    print(
+        f"\nDone in {elapsed:.1f} s: {rendered} rendered, {failed} failed, {skipped} skipped (already rendered)",
+        file=sys.stderr,
+    )
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
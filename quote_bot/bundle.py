@@ -0,0 +1,193 @@
+"""
+Build-time bundle of artifacts that are slow to prepare on a cold start:
+decoded template rasters, template previews and font metric tables.
+
+Build it with:
+    python -m quote_bot.bundle
+"""
+
+import json
+from argparse import ArgumentParser
+from functools import lru_cache
+from hashlib import sha256
+from mmap import ACCESS_READ, mmap
+from os import makedirs, remove
+from os.path import basename, isfile
+from os.path import join as join_path
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+import PIL
+from PIL import Image
+
+from quote_bot.settings import DesignerSettings
+
+VERSION = 1
+MANIFEST = "manifest.json"
+
+# Words measured at build time: every single character and the most common short words
+_ALPHABET = (
+    "абвгдеёжзийклмнопрстуфхцчшщъыьэюяАБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ"
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+    ".,:;!?-‑–—\"'«»()…@#%&*+=/"
+)
+
+
+class TemplateArtifacts(NamedTuple):
+    image: Image.Image  # RGBA template
+    filled_image: Image.Image  # RGB template on its solid background
+    preview: bytes  # PNG
+
+
+def file_hash(path: str) -> str:
+    with open(path, "rb") as file:
+        return sha256(file.read()).hexdigest()
+
+
+class Bundle:
+    """
+    Artifacts bundle reader. Every artifact is checked against its source file and the current settings,
+    outdated artifacts are ignored (the caller prepares them as usual)
+    """
+
+    def __init__(self, path: str):
+        """
+        Open bundle
+        :param path: bundle directory
+        :raise ValueError: bundle was built by another version
+        """
+        self._path = path
+        with open(join_path(path, MANIFEST)) as file:
+            self._manifest = json.load(file)
+        if self._manifest.get("version") != VERSION:
+            raise ValueError(f"Unsupported bundle version {self._manifest.get('version')}")
+
+    def template(
+        self, name: str, source_path: str, background_color: Tuple[int, int, int]
+    ) -> Optional[TemplateArtifacts]:
+        """
+        Load template artifacts
+        :param name: template name
+        :param source_path: path to the template .png file
+        :param background_color: template background color
+        :return: artifacts or None if they are missing or outdated
+        """
+        entry = self._manifest["templates"].get(name)
+        if (
+            not entry
+            or entry["source"] != file_hash(source_path)
+            or entry["preview_width"] != DesignerSettings.default_preview_width()
+            or tuple(entry["background_color"]) != tuple(background_color)
+        ):
+            return None
+
+        size = tuple(entry["size"])
+        # RGBA raster is memory-mapped: pages are read on first access and shared between processes
+        with open(join_path(self._path, entry["image"]), "rb") as file:
+            image = Image.frombuffer("RGBA", size, mmap(file.fileno(), 0, access=ACCESS_READ), "raw", "RGBA", 0, 1)
+        with open(join_path(self._path, entry["filled_image"]), "rb") as file:
+            filled_image = Image.frombytes("RGB", size, file.read())
+        with open(join_path(self._path, entry["preview"]), "rb") as file:
+            preview = file.read()
+        return TemplateArtifacts(image, filled_image, preview)
+
+    def font_metrics(self, path_to_font: str) -> Optional[Dict]:
+        """
+        Load font metric table
+        :param path_to_font: path to .ttf font file
+        :return: table (see FontMetrics) or None if it is missing or outdated
+        """
+        entry = self._manifest["fonts"].get(basename(path_to_font))
+        # Glyph sizes depend on the FreeType version shipped with Pillow
+        if not entry or entry["source"] != file_hash(path_to_font) or entry["pillow"] != PIL.__version__:
+            return None
+        with open(join_path(self._path, entry["metrics"])) as file:
+            return json.load(file)
+
+
+@lru_cache(maxsize=None)
+def load_bundle(path: Optional[str] = None) -> Optional[Bundle]:
+    """
+    Open the bundle (once per process)
+    :param path: bundle directory (DesignerSettings.bundle_dir by default)
+    :return: bundle or None if it was not built
+    """
+    path = path or DesignerSettings.bundle_dir()
+    if not isfile(join_path(path, MANIFEST)):
+        return None
+    try:
+        return Bundle(path)
+    except (OSError, ValueError):
+        return None
+
+
+def _build_templates(path: str) -> Dict[str, Dict]:
+    from quote_bot.templates import TemplatesManager
+
+    entries = {}
+    for name, template in TemplatesManager(cache_renders=False, bundle=False).all_templates().items():
+        entry = {
+            "source": file_hash(template.path),
+            "size": list(template.size),
+            "preview_width": DesignerSettings.default_preview_width(),
+            "background_color": list(template.background_color),
+            "image": f"{name}.rgba",
+            "filled_image": f"{name}.rgb",
+            "preview": f"{name}.preview.png",
+        }
+        with open(join_path(path, entry["image"]), "wb") as file:
+            file.write(template.pil_image.tobytes())
+        with open(join_path(path, entry["filled_image"]), "wb") as file:
+            file.write(template.canvas().tobytes())
+        with open(join_path(path, entry["preview"]), "wb") as file:
+            file.write(template.preview)
+        entries[name] = entry
+    return entries
+
+
+def _build_fonts(path: str, words: Iterable[str]) -> Dict[str, Dict]:
+    from quote_bot.optimizator.layout import FontMetrics
+
+    entries = {}
+    for path_to_font in {DesignerSettings.path_to_font(), DesignerSettings.path_to_caption_font()}:
+        name = basename(path_to_font)
+        entry = {"source": file_hash(path_to_font), "pillow": PIL.__version__, "metrics": f"{name}.metrics.json"}
+        with open(join_path(path, entry["metrics"]), "w") as file:
+            json.dump(FontMetrics(path_to_font).table(words), file, ensure_ascii=False)
+        entries[name] = entry
+    return entries
+
+
+def build(path: str, words: Iterable[str] = ()):
+    """
+    Build bundle
+    :param path: output directory
+    :param words: additional words to measure, e.g. the most frequent words of the posters
+    """
+    from quote_bot.textmanager.textmanager import FilterHangingPreposition
+
+    makedirs(path, exist_ok=True)
+    if isfile(join_path(path, MANIFEST)):
+        remove(join_path(path, MANIFEST))
+    words = set(_ALPHABET) | FilterHangingPreposition.common_words | set(words)
+    manifest = {"version": VERSION, "templates": _build_templates(path), "fonts": _build_fonts(path, words)}
+    # Manifest goes last: a bundle without it is never used
+    with open(join_path(path, MANIFEST), "w") as file:
+        json.dump(manifest, file, indent=2)
+
+
+def main():
+    parser = ArgumentParser(description="Build templates, previews and font metrics bundle")
+    parser.add_argument("--output", default=DesignerSettings.bundle_dir(), help="bundle directory")
+    parser.add_argument("--words", help="text file with additional words to measure (one per line)")
+    args = parser.parse_args()
+
+    words = []
+    if args.words:
+        with open(args.words) as file:
+            words = [line.strip() for line in file if line.strip()]
+    build(args.output, words)
+    print(f"Bundle saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+from asyncio import Future, ensure_future, shield
+from collections import OrderedDict
+from os import getpid, makedirs, remove, replace, scandir, stat, utime
+from os.path import join
+from threading import Event, Lock, get_ident
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class BoundedCache:
+    """
+    Thread-safe LRU cache bounded by the total weight of its values and (optionally) by their age
+    """
+
+    def __init__(self, max_weight: int, weight: Optional[Callable[[Any], int]] = None, ttl: Optional[float] = None):
+        """
+        Create cache
+        :param max_weight: maximum total weight of values (number of values by default)
+        :param weight: function to compute value weight, e.g. len for bytes
+        :param ttl: time to live of values in seconds (forever by default)
+        """
+        self._max_weight = max_weight
+        self._weight = weight or (lambda value: 1)
+        self._ttl = ttl
+        self._items = OrderedDict()  # key -> (value, weight, expiration time)
+        self._total_weight = 0
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _item(self, key: Hashable) -> Optional[Tuple[Any, int, Optional[float]]]:
+        """
+        Item of the key, expired item is removed (call with the lock taken)
+        """
+        item = self._items.get(key)
+        if item is not None and item[2] is not None and item[2] < monotonic():
+            self._total_weight -= self._items.pop(key)[1]
+            return None
+        return item
+
+    def _remove_expired(self):
+        """
+        Remove all expired items (call with the lock taken)
+        """
+        if not self._ttl:  # Values never expire
+            return
+        now = monotonic()
+        for key in [key for key, item in self._items.items() if item[2] is not None and item[2] < now]:
+            self._total_weight -= self._items.pop(key)[1]
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._item(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key: Hashable, value: Any):
+        weight = self._weight(value)
+        with self._lock:
+            if key in self._items:
+                self._total_weight -= self._items.pop(key)[1]
+            if weight > self._max_weight:
+                return  # Too big to be cached at all
+            self._items[key] = value, weight, (monotonic() + self._ttl if self._ttl else None)
+            self._total_weight += weight
+            while self._total_weight > self._max_weight:
+                _, (_, evicted_weight, _) = self._items.popitem(last=False)
+                self._total_weight -= evicted_weight
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is not None:
+                self._total_weight -= item[1]
+
+    def get_or_set(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        Get value or compute and cache it
+        :param key: cache key
+        :param factory: function to compute missing value
+        """
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._total_weight = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._remove_expired()
+            return len(self._items)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return self._item(key) is not None
+
+    def stats(self) -> Dict[str, float]:
+        requests = self.hits + self.misses
+        with self._lock:
+            self._remove_expired()
+            size, weight = len(self._items), self._total_weight
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "size": size,
+            "weight": weight,
+        }
+
+
+class DiskCache:
+    """
+    Bytes cache in a directory bounded by the total size of files. Least recently used files are evicted first
+    """
+
+    def __init__(self, path: str, max_size: int):
+        """
+        Create cache
+        :param path: cache directory (created if missing)
+        :param max_size: maximum total size of files in bytes
+        """
+        makedirs(path, exist_ok=True)
+        self._path = path
+        self._max_size = max_size
+        self._size = sum(entry.stat().st_size for entry in scandir(path) if entry.is_file())
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Get value
+        :param key: file name (e.g. hex digest)
+        """
+        path = join(self._path, key)
+        try:
+            with open(path, "rb") as file:
+                value = file.read()
+            utime(path)  # Mark as recently used
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: bytes):
+        if len(value) > self._max_size:
+            return
+
+        path = join(self._path, key)
+        temp_path = f"{path}.{getpid()}.{get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(value)
+
+        with self._lock:
+            try:
+                self._size -= stat(path).st_size  # The value is overwritten
+            except OSError:
+                pass
+            replace(temp_path, path)  # Readers never see partially written files
+            self._size += len(value)
+            if self._size > self._max_size:
+                self._evict()
+
+    def _evict(self):
+        # Other processes may share the directory, so look at the real files
+        files = []
+        for entry in scandir(self._path):
+            if entry.is_file():
+                entry_stat = entry.stat()
+                files.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+        files.sort()
+
+        self._size = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if self._size <= self._max_size:
+                break
+            try:
+                remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+    def stats(self) -> Dict[str, float]:
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "weight": self._size,
+        }
+
+
+class _Call:
+    def __init__(self):
+        self.done = Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Thread-safe in-flight deduplication: concurrent calls with the same key run the function once,
+    the rest wait for its result (or its exception)
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = dict()
+        self._lock = Lock()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Call function or wait for the same call already running
+        :param key: call key
+        :param func: function to call
+        :return: Tuple[result, True if the result of another call was shared]
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            shared = call is not None
+            if not shared:
+                call = self._calls[key] = _Call()
+
+        if shared:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class AsyncSingleFlight:
+    """
+    In-flight deduplication of coroutines in one event loop, see SingleFlight
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, Future] = dict()
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]) -> Tuple[Any, bool]:
+        """
+        Await coroutine function or the same call already running
+        :param key: call key
+        :param func: coroutine function
+        :return: Tuple[result, True if the result of another call was shared]
+        """
+        future = self._calls.get(key)
+        shared = future is not None
+        if not shared:
+            future = self._calls[key] = ensure_future(func())
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        # Cancelled caller does not cancel the call others are waiting for
+        return await shield(future), shared
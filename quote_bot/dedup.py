@@ -0,0 +1,62 @@
+import logging
+
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from quote_bot import metrics
+from quote_bot.cache import BoundedCache
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateLog:
+    """
+    In-process log of update ids being processed or processed recently
+    """
+
+    def __init__(self, ttl: int, size: int):
+        """
+        :param ttl: update ids are remembered for this time (in seconds)
+        :param size: maximum number of remembered update ids
+        """
+        self._updates = BoundedCache(size, ttl=ttl)
+
+    async def claim_update(self, update_id: int) -> bool:
+        """
+        Remember the update
+        :return: False if the update was claimed already
+        """
+        if self._updates.get(update_id) is not None:
+            return False
+        self._updates.set(update_id, True)  # No await in between: check and set are atomic in the event loop
+        return True
+
+    async def release_update(self, update_id: int):
+        """
+        Forget the update, so a repeat of it is processed again
+        """
+        self._updates.delete(update_id)
+
+
+class DeduplicationMiddleware(BaseMiddleware):
+    """
+    Drop repeated updates. Telegram re-sends an update if the webhook did not answer in time,
+    each repeat would render and upload the same poster once more and make the next answer even slower.
+    A repeat is answered right away without processing, an update that failed is released to be processed again
+    """
+
+    def __init__(self, update_log):
+        """
+        :param update_log: UpdateLog or DynamoStorage (conditional put with TTL, shared by all Lambda containers)
+        """
+        self._log = update_log
+        super(DeduplicationMiddleware, self).__init__()
+
+    async def on_pre_process_update(self, update, data: dict):
+        if not await self._log.claim_update(update.update_id):
+            metrics.count("duplicate_updates")
+            logger.info(f"Update {update.update_id} is processed already, dropped")
+            raise CancelHandler()
+
+    async def on_pre_process_error(self, update, error, data: dict):
+        await self._log.release_update(update.update_id)
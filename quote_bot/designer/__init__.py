@@ -1,3 +1,18 @@
-from .designer import Align, add_background_on_image, add_text_on_image, compile_image, fill_color
+from .background import BackgroundTooLarge, BadBackground, fit_background, open_background
+from .designer import Align, add_background_on_image, add_text_on_image, fill_color
+from .output import OUTPUT_PROFILES, OutputProfile, compile_image, compile_images
 
-__all__ = ["add_text_on_image", "Align", "compile_image", "add_background_on_image", "fill_color"]
+__all__ = [
+    "add_text_on_image",
+    "Align",
+    "compile_image",
+    "compile_images",
+    "add_background_on_image",
+    "fill_color",
+    "BadBackground",
+    "BackgroundTooLarge",
+    "fit_background",
+    "open_background",
+    "OutputProfile",
+    "OUTPUT_PROFILES",
+]
@@ -0,0 +1,79 @@
+from math import ceil
+from typing import BinaryIO, Tuple
+
+from PIL import Image
+
+from .. import metrics
+from ..settings import DesignerSettings
+
+
+class BadBackground(Exception):
+    """
+    Background file is not an image Pillow can read
+    """
+
+
+class BackgroundTooLarge(Exception):
+    """
+    Background image has too many pixels
+    """
+
+
+def _cover_box(image_size: Tuple[int, int], size: Tuple[int, int]) -> Tuple[float, float, float, float]:
+    """
+    Centered region of the image with the aspect ratio of SIZE, as big as possible
+    :param image_size: image width and height
+    :param size: required width and height
+    :return: box (left, upper, right, lower) in image coordinates
+    """
+    scale = max(size[0] / image_size[0], size[1] / image_size[1])
+    width, height = size[0] / scale, size[1] / scale
+    left, upper = (image_size[0] - width) / 2, (image_size[1] - height) / 2
+    return left, upper, left + width, upper + height
+
+
+def fit_background(image, size: Tuple[int, int]):
+    """
+    Scale the image to cover SIZE and crop the center, in one resize call
+    :param image: PIL Image
+    :param size: required width and height
+    :return: PIL Image (RGB)
+    """
+    if image.mode not in ("RGB", "RGBA", "L"):
+        image = image.convert("RGB")  # Palette and CMYK images can not be resampled
+    if image.size != size:
+        image = image.resize(size, Image.BICUBIC, box=_cover_box(image.size, size), reducing_gap=3.0)
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
+def open_background(file: BinaryIO, size: Tuple[int, int]):
+    """
+    Decode background image straight to the required size
+    JPEG images are decoded at a reduced scale (1/2 .. 1/8) when they are much bigger than required
+    :param file: image file
+    :param size: required width and height
+    :return: PIL Image (RGB)
+    :raise BadBackground: file is not an image
+    :raise BackgroundTooLarge: image has more than DesignerSettings.max_background_pixels() pixels
+    """
+    try:
+        image = Image.open(file)  # Reads the header only
+    except Image.DecompressionBombError as error:  # Pillow's own pixels limit
+        raise BackgroundTooLarge() from error
+    except OSError as error:
+        raise BadBackground() from error
+
+    if image.width * image.height > DesignerSettings.max_background_pixels():
+        raise BackgroundTooLarge()
+
+    scale = max(size[0] / image.width, size[1] / image.height)
+    image.draft("RGB", (ceil(image.width * scale), ceil(image.height * scale)))
+
+    try:
+        with metrics.stage("background_decode"):
+            image.load()
+            return fit_background(image, size)
+    except Image.DecompressionBombError as error:
+        raise BackgroundTooLarge() from error
+    except OSError as error:  # Truncated or broken file
+        raise BadBackground() from error
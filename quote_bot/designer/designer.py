@@ -1,13 +1,14 @@
-import io
 from enum import Enum
 from enum import auto as enum_auto
 from typing import Optional, Tuple
 
-from PIL import Image, ImageDraw, ImageFont
-from resizeimage.resizeimage import resize_crop
+from PIL import Image, ImageDraw
 
+from .. import metrics
+from ..fontmanager import get_font
 from ..optimizator import optimize_font_size
 from ..settings import DesignerSettings
+from .background import fit_background
 
 
 class Align(Enum):
@@ -15,17 +16,6 @@ class Align(Enum):
     center = enum_auto()
 
 
-def compile_image(pil_image) -> bytes:
-    """
-    Convert Pillow image to telegram image
-    """
-    # Convert to bytes
-    with io.BytesIO() as output:
-        pil_image.save(output, format="PNG")
-        png = output.getvalue()
-    return png
-
-
 def add_text_on_image(
     pil_image,
     text: str,
@@ -34,6 +24,7 @@ def add_text_on_image(
     path_to_font: str,
     align: Align = Align.center,
     fixed_font_size: Optional[int] = None,
+    layout_size: Optional[Tuple[int, int]] = None,
 ):
     """
     Add text on Pillow image
@@ -45,51 +36,50 @@ def add_text_on_image(
     :param wrap: wrap text (default - True)
     :param align: text align
     :param fixed_font_size: Font size. If not provided, font size will be adjusted
+    :param layout_size: image size the layout is optimized for (the image size by default).
+    Text on smaller images is laid out the same way, only scaled down
     :return: Pillow image
     """
+    layout_width, layout_height = layout_size or pil_image.size
+    scale = pil_image.width / layout_width
 
     x0, y0, x1, y1 = position
     x0, x1 = int(x0 * pil_image.width), int(x1 * pil_image.width)
     y0, y1 = int(y0 * pil_image.height), int(y1 * pil_image.height)
 
-    if not fixed_font_size:
-        font_size, wrapped_text = optimize_font_size(
-            x1 - x0, y1 - y0, text, path_to_font, DesignerSettings.max_font_size()
-        )
-    else:
-        font_size, wrapped_text = fixed_font_size, text
-
-    # Create PIL font object
-    font = ImageFont.truetype(path_to_font, font_size)
-    draw = ImageDraw.Draw(pil_image)
-    text_width, text_height = draw.textsize(wrapped_text, font)
-
-    if align is Align.center:
-        position = (x0 + (x1 - x0 - text_width) / 2, y0 + (y1 - y0 - text_height) / 2)
-    elif align is Align.left:
-        position = x0, y0
-    draw.text(position, wrapped_text, color, font=font, align=align.name)
+    with metrics.stage("draw_text"):  # Including layout optimization
+        if not fixed_font_size:
+            box_width = int(position[2] * layout_width) - int(position[0] * layout_width)
+            box_height = int(position[3] * layout_height) - int(position[1] * layout_height)
+            font_size, wrapped_text = optimize_font_size(
+                box_width, box_height, text, path_to_font, DesignerSettings.max_font_size()
+            )
+        else:
+            font_size, wrapped_text = fixed_font_size, text
+        font_size = max(int(font_size * scale), 1)
+
+        # Create PIL font object
+        font = get_font(path_to_font, font_size)
+        draw = ImageDraw.Draw(pil_image)
+        text_width, text_height = draw.textsize(wrapped_text, font)
+
+        if align is Align.center:
+            position = (x0 + (x1 - x0 - text_width) / 2, y0 + (y1 - y0 - text_height) / 2)
+        elif align is Align.left:
+            position = x0, y0
+        draw.text(position, wrapped_text, color, font=font, align=align.name)
 
     return pil_image
 
 
-def _resize_to_max(req_size: Tuple[int, int], image):
-    if req_size[0] > image.size[0]:
-        image = image.resize((req_size[0], int(req_size[0] / image.size[0] * image.size[1])))
-    if req_size[1] > image.size[1]:
-        image = image.resize((int(req_size[1] / image.size[1] * image.size[0]), req_size[1]))
-    return image
-
-
 def add_background_on_image(pil_image, background_pil):
     """
     Add background on image
     :param pil_image: PIL Image
-    :param background_pil: background to add PIL Image
+    :param background_pil: background to add PIL Image (scaled and cropped to the image size if needed)
     :return: PIL Image
     """
-    background_pil = _resize_to_max(pil_image.size, background_pil)
-    background_pil = resize_crop(background_pil, pil_image.size)
+    background_pil = fit_background(background_pil, pil_image.size)
 
     background_pil.paste(pil_image, (0, 0), pil_image)
 
@@ -0,0 +1,81 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Dict, NamedTuple, Optional, Sequence
+
+from PIL import Image
+
+from .. import metrics
+from ..settings import DesignerSettings
+
+
+class OutputProfile(NamedTuple):
+    """
+    Image encoding settings
+    """
+
+    format: str
+    params: Dict
+    max_width: Optional[int] = None  # Downscale wider images
+    quantize: bool = False  # Use palette for flat-colour images (no background photo)
+
+
+OUTPUT_PROFILES: Dict[str, OutputProfile] = {
+    # Lossless PNG with default settings
+    "png": OutputProfile("PNG", {}),
+    # Full size poster for print, sent as a document: fast compression
+    "document": OutputProfile("PNG", {"compress_level": 1}, quantize=DesignerSettings.quantize_flat_posters()),
+    # Inline preview for answer_photo: Telegram shrinks photos to 1280 px anyway
+    "photo": OutputProfile("JPEG", {"quality": 90}, max_width=1280),
+    "webp": OutputProfile("WEBP", {"quality": 90, "method": 2}, max_width=1280),
+}
+
+# Pillow releases GIL while encoding, so profiles are encoded in parallel
+_encoder = ThreadPoolExecutor(len(OUTPUT_PROFILES))
+
+
+def compile_image(pil_image, profile: str = "png", flat: bool = False) -> bytes:
+    """
+    Convert Pillow image to telegram image
+    :param pil_image: PIL Image
+    :param profile: output profile name, see OUTPUT_PROFILES
+    :param flat: image has only solid colours (palette may be used)
+    :return: encoded image
+    """
+    with metrics.stage(f"encode_{profile}"):
+        return _compile_image(pil_image, OUTPUT_PROFILES[profile], flat)
+
+
+def _compile_image(pil_image, output_profile: OutputProfile, flat: bool) -> bytes:
+    """
+    Downscale, quantize or convert the image as the profile requires and encode it
+    :param pil_image: PIL Image
+    :param output_profile: output profile
+    :param flat: image has only solid colours (palette may be used)
+    :return: encoded image
+    """
+    if output_profile.max_width and pil_image.width > output_profile.max_width:
+        height = round(pil_image.height * output_profile.max_width / pil_image.width)
+        pil_image = pil_image.resize((output_profile.max_width, height), Image.LANCZOS, reducing_gap=3.0)
+    if output_profile.quantize and flat:
+        pil_image = pil_image.quantize()
+    elif output_profile.format == "JPEG" and pil_image.mode != "RGB":
+        pil_image = pil_image.convert("RGB")
+
+    with io.BytesIO() as output:
+        pil_image.save(output, format=output_profile.format, **output_profile.params)
+        return output.getvalue()
+
+
+def compile_images(pil_image, profiles: Sequence[str], flat: bool = False) -> Dict[str, bytes]:
+    """
+    Encode image with several profiles in parallel
+    :return: Dict[profile name, encoded image]
+    """
+    if len(profiles) == 1:
+        return {profiles[0]: compile_image(pil_image, profiles[0], flat)}
+    # Each encoder thread records its stage in the trace of the caller
+    futures = {
+        profile: _encoder.submit(copy_context().run, compile_image, pil_image, profile, flat) for profile in profiles
+    }
+    return {profile: future.result() for profile, future in futures.items()}
@@ -1,7 +1,33 @@
+import logging
 import typing
+from asyncio import gather, get_event_loop
+from contextvars import ContextVar
+from copy import deepcopy
+from functools import partial
+from time import time
 
 from aiogram.contrib.fsm_storage.memory import BaseStorage
 
+from quote_bot.settings import BotSettings
+
+logger = logging.getLogger(__name__)
+
+
+class _UpdateItem:
+    """
+    DynamoDB item read and changed while processing one update
+    """
+
+    def __init__(self):
+        self.item: typing.Optional[typing.Dict] = None  # None - not read yet
+        self.changes: typing.Dict = dict()
+
+
+# Items of the update being processed (None outside of update processing)
+_update_items: ContextVar[typing.Optional[typing.Dict[typing.Tuple[int, int], _UpdateItem]]] = ContextVar(
+    "dynamo_update_items", default=None
+)
+
 
 class DynamoStorage(BaseStorage):
     """
@@ -9,6 +35,7 @@ class DynamoStorage(BaseStorage):
     """
 
     _table_name = "AiogramFSMTable"
+    _updates_user = 0  # Service address of the update log: user 0, chat = update id
 
     async def close(self):
         pass
@@ -31,25 +58,145 @@ class DynamoStorage(BaseStorage):
         )
 
         # Wait until the table exists.
-        self._table.meta.client.get_waiter("table_exists").wait(TableName=self._table_name)
+        self._database.meta.client.get_waiter("table_exists").wait(TableName=self._table_name)
+        self._enable_ttl()
         return table
 
+    def _enable_ttl(self):
+        """
+        Turn on DynamoDB TTL: items with "expires" attribute (update log, service items) are deleted after this time.
+        Tables created by older versions have it off, so it is checked once per process
+        """
+        client = self._database.meta.client
+        try:
+            description = client.describe_time_to_live(TableName=self._table_name)["TimeToLiveDescription"]
+            if description["TimeToLiveStatus"] in ("ENABLED", "ENABLING"):
+                if description.get("AttributeName") != "expires":
+                    logger.warning(f"TTL of {self._table_name} is set on another attribute, update log is not cleaned")
+                return
+            client.update_time_to_live(
+                TableName=self._table_name, TimeToLiveSpecification={"Enabled": True, "AttributeName": "expires"}
+            )
+        except client.exceptions.ResourceNotFoundException:
+            pass  # TTL is turned on when the table is created
+        except Exception:  # E.g. no dynamodb:UpdateTimeToLive permission: expired items are overwritten anyway
+            logger.exception(f"Could not enable TTL of {self._table_name}")
+
     def __init__(self, database):
         """
         DynamoDB storage
         :param database: boto3.resource object
         """
         self._database = database
+        self._updates_ttl = BotSettings.update_dedup_ttl()
+        self._ttl_checked = False
+        # Table handle is lazy: no requests until the first read/write (the table is created if it is missing)
+        self._table = self._database.Table(self._table_name)
 
-        tables = self._database.meta.client.list_tables()["TableNames"]
-        if self._table_name not in tables:
+    def _call(self, method: str, **kwargs):
+        try:
+            return getattr(self._table, method)(**kwargs)
+        except self._database.meta.client.exceptions.ResourceNotFoundException:
             self._table = self._create_table()
+            return getattr(self._table, method)(**kwargs)
+
+    async def _run(self, method: str, **kwargs):
+        """
+        Run blocking boto3 table call out of the event loop
+        """
+        return await get_event_loop().run_in_executor(None, partial(self._call, method, **kwargs))
+
+    async def _read_item(self, chat_id: int, user_id: int) -> typing.Dict:
+        item = await self._run("get_item", Key={"user_id": user_id, "chat_id": chat_id})
+        return item.get("Item", None) or dict()
+
+    async def _write_item(self, chat_id: int, user_id: int, changes: typing.Dict):
+        names = {f"#f{i}": name for i, name in enumerate(changes)}
+        values = {f":v{i}": value for i, value in enumerate(changes.values())}
+        await self._run(
+            "update_item",
+            Key={"user_id": user_id, "chat_id": chat_id},
+            UpdateExpression="SET " + ", ".join(f"#f{i} = :v{i}" for i in range(len(changes))),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+        )
+
+    async def _get_item(self, chat_id: int, user_id: int) -> typing.Dict:
+        """
+        Get item. Inside an update the item is read once and cached until the end of the update
+        """
+        items = _update_items.get()
+        if items is None:
+            return await self._read_item(chat_id, user_id)
+
+        update_item = items.setdefault((chat_id, user_id), _UpdateItem())
+        if update_item.item is None:
+            update_item.item = await self._read_item(chat_id, user_id)
+        return {**update_item.item, **update_item.changes}
+
+    async def _update_item(self, chat_id: int, user_id: int, **changes):
+        """
+        Update item fields. Inside an update changes are written by flush() at the end of the update
+        """
+        items = _update_items.get()
+        if items is None:
+            await self._write_item(chat_id, user_id, changes)
         else:
-            self._table = self._database.Table(self._table_name)
+            items.setdefault((chat_id, user_id), _UpdateItem()).changes.update(deepcopy(changes))
 
-    async def _get_item(self, chat_id: int, user_id: int) -> typing.Optional[typing.Dict]:
-        item = self._table.get_item(Key={"user_id": user_id, "chat_id": chat_id})
-        return item.get("Item", None)
+    def begin_update(self):
+        """
+        Start caching reads and collecting writes of the current update
+        """
+        _update_items.set(dict())
+
+    async def flush(self):
+        """
+        Write changes of the current update: at most one update_item per (chat, user)
+        """
+        items = _update_items.get()
+        _update_items.set(None)
+        if not items:
+            return
+        await gather(
+            *(
+                self._write_item(chat_id, user_id, update_item.changes)
+                for (chat_id, user_id), update_item in items.items()
+                if update_item.changes
+            )
+        )
+
+    async def _check_ttl(self):
+        if not self._ttl_checked:
+            self._ttl_checked = True
+            await get_event_loop().run_in_executor(None, self._enable_ttl)
+
+    async def claim_update(self, update_id: int) -> bool:
+        """
+        Remember the update for BotSettings.update_dedup_ttl() seconds (conditional put, atomic across containers)
+        :return: False if the update was claimed already
+        """
+        await self._check_ttl()
+
+        now = int(time())
+        try:
+            await self._run(
+                "put_item",
+                Item={"user_id": self._updates_user, "chat_id": update_id, "expires": now + self._updates_ttl},
+                # DynamoDB deletes expired items lazily (up to days later), so they are checked here too
+                ConditionExpression="attribute_not_exists(user_id) OR #expires < :now",
+                ExpressionAttributeNames={"#expires": "expires"},
+                ExpressionAttributeValues={":now": now},
+            )
+        except self._database.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    async def release_update(self, update_id: int):
+        """
+        Forget the update, so a repeat of it is processed again
+        """
+        await self._run("delete_item", Key={"user_id": self._updates_user, "chat_id": update_id})
 
     async def get_state(
         self,
@@ -60,8 +207,6 @@ class DynamoStorage(BaseStorage):
     ) -> typing.Optional[str]:
         chat, user = self.check_address(chat=chat, user=user)
         item = await self._get_item(int(chat), int(user))
-        if not item:
-            return default
         return item.get("FSMState", default)
 
     async def set_state(
@@ -72,11 +217,7 @@ class DynamoStorage(BaseStorage):
         state: typing.Optional[typing.AnyStr] = None
     ):
         chat, user = self.check_address(chat=chat, user=user)
-        self._table.update_item(
-            Key={"user_id": int(user), "chat_id": int(chat)},
-            UpdateExpression="SET FSMData = :val1",
-            ExpressionAttributeValues={":val1": state},
-        )
+        await self._update_item(int(chat), int(user), FSMState=state)
 
     async def get_data(
         self,
@@ -87,23 +228,38 @@ class DynamoStorage(BaseStorage):
     ) -> typing.Dict:
         chat, user = self.check_address(chat=chat, user=user)
         item = await self._get_item(int(chat), int(user))
-        if not item:
-            return dict()
-        return item.get("FSMData", dict())
+        return deepcopy(item.get("FSMData", dict()))
 
     async def set_data(
         self,
         *,
         chat: typing.Union[str, int, None] = None,
         user: typing.Union[str, int, None] = None,
-        data: typing.Dict = None
+        data: typing.Dict = None,
+        ttl: typing.Optional[int] = None
+    ):
+        """
+        :param ttl: DynamoDB deletes the item after this time (in seconds), e.g. service items. Forever by default
+        """
+        chat, user = self.check_address(chat=chat, user=user)
+        if ttl is None:
+            await self._update_item(int(chat), int(user), FSMData=data or dict())
+            return
+        await self._check_ttl()
+        await self._update_item(int(chat), int(user), FSMData=data or dict(), expires=int(time()) + ttl)
+
+    async def delete_data(
+        self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None
     ):
+        """
+        Delete the item (state and data) right away
+        """
         chat, user = self.check_address(chat=chat, user=user)
-        self._table.update_item(
-            Key={"user_id": int(user), "chat_id": int(chat)},
-            UpdateExpression="SET FSMData = :val1",
-            ExpressionAttributeValues={":val1": data},
-        )
+        items = _update_items.get()
+        if items is not None:  # Reads of the update see the item deleted, buffered changes are dropped
+            items[(int(chat), int(user))] = update_item = _UpdateItem()
+            update_item.item = dict()
+        await self._run("delete_item", Key={"user_id": int(user), "chat_id": int(chat)})
 
     async def update_data(
         self,
@@ -113,8 +269,8 @@ class DynamoStorage(BaseStorage):
         data: typing.Dict = None,
         **kwargs
     ):
-        r_data = await self.get_data(chat=chat, user=user)
-        w_data = r_data.update(data) if r_data else data
+        w_data = await self.get_data(chat=chat, user=user)
+        w_data.update(data or dict(), **kwargs)
         await self.set_data(chat=chat, user=user, data=w_data)
 
     async def get_bucket(
@@ -147,3 +303,24 @@ class DynamoStorage(BaseStorage):
 
     def has_bucket(self):
         return False
+
+
+async def set_service_data(storage: BaseStorage, chat: int, user: int, data: typing.Dict, ttl: int):
+    """
+    Save data of a service item (file_id, privileges): DynamoDB deletes it after ttl seconds,
+    other storages keep it until it is overwritten
+    """
+    if isinstance(storage, DynamoStorage):
+        await storage.set_data(chat=chat, user=user, data=data, ttl=ttl)
+    else:
+        await storage.set_data(chat=chat, user=user, data=data)
+
+
+async def delete_service_data(storage: BaseStorage, chat: int, user: int):
+    """
+    Delete a service item
+    """
+    if isinstance(storage, DynamoStorage):
+        await storage.delete_data(chat=chat, user=user)
+    else:
+        await storage.reset_data(chat=chat, user=user)
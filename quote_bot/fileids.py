@@ -0,0 +1,104 @@
+from hashlib import sha256
+from io import BytesIO
+from typing import Awaitable, Callable, Optional, Union
+
+import aiogram.types as types
+from aiogram import Dispatcher
+from aiogram.types import InputFile
+from aiogram.utils.exceptions import BadRequest
+
+from quote_bot import metrics
+from quote_bot.cache import BoundedCache
+from quote_bot.dynamo import delete_service_data, set_service_data
+from quote_bot.settings import BotSettings
+
+
+class FileIds:
+    """
+    Telegram file_id of uploaded files. Sending file_id is almost free compared to uploading the file again.
+    Persisted in the dispatcher storage, one item per file: service user -1, chat = numeric hash of the file key.
+    Only the item of the uploaded file is written, so concurrent processes never overwrite each other's file_ids.
+    Items expire after FILE_IDS_TTL (the file is uploaded again then)
+    """
+
+    _user = -1
+
+    def __init__(self, limit: int, ttl: int):
+        """
+        :param limit: maximum number of file_ids kept in memory (the rest are read from the storage)
+        :param ttl: file_ids are kept in the storage for this time (in seconds)
+        """
+        self._memory = BoundedCache(limit)
+        self._ttl = ttl
+
+    @staticmethod
+    def _chat(key: str) -> int:
+        # 63-bit hash: fits DynamoDB number and does not clash with chat 0 of other service items
+        return int.from_bytes(sha256(key.encode()).digest()[:8], "big") >> 1 or 1
+
+    async def get(self, key: str) -> Optional[str]:
+        file_id = self._memory.get(key)
+        if file_id is None:
+            storage = Dispatcher.get_current().storage
+            data = await storage.get_data(chat=self._chat(key), user=self._user)
+            if data.get("key") == key and data.get("file_id"):
+                file_id = data["file_id"]
+                self._memory.set(key, file_id)
+        return file_id
+
+    async def set(self, key: str, file_id: str):
+        self._memory.set(key, file_id)
+        storage = Dispatcher.get_current().storage
+        data = {"key": key, "file_id": file_id}
+        await set_service_data(storage, self._chat(key), self._user, data, self._ttl)
+
+    async def forget(self, key: str):
+        self._memory.delete(key)
+        storage = Dispatcher.get_current().storage
+        await delete_service_data(storage, self._chat(key), self._user)
+
+
+file_ids = FileIds(BotSettings.file_ids_limit(), BotSettings.file_ids_ttl())
+
+
+async def answer_file(
+    message: types.Message,
+    kind: str,
+    key: str,
+    file: Union[bytes, Callable[[], Awaitable[Optional[bytes]]]],
+    filename: Optional[str] = None,
+    **kwargs,
+) -> Optional[types.Message]:
+    """
+    Send photo or document by its known file_id, or upload the file and remember its file_id
+    :param message: message to answer
+    :param kind: "photo" or "document"
+    :param key: file key, e.g. content hash
+    :param file: file content or coroutine function returning it (called only if the file must be uploaded)
+    :param filename: document file name
+    :return: sent message (None if the coroutine function returned None)
+    """
+    send = {"photo": message.answer_photo, "document": message.answer_document}[kind]
+
+    file_id = await file_ids.get(key)
+    if file_id:
+        try:
+            sent = await send(file_id, **kwargs)
+        except BadRequest:  # file_id is not valid anymore, e.g. bot token was changed
+            await file_ids.forget(key)
+        else:
+            metrics.count(f"{kind}_file_id_hits")
+            return sent
+
+    content = file if isinstance(file, bytes) else await file()
+    if content is None:
+        return None
+
+    if kind == "document":
+        content = InputFile(BytesIO(content), filename=filename)
+    with metrics.stage(f"upload_{kind}"):
+        sent = await send(content, **kwargs)
+
+    uploaded = sent.photo[-1] if kind == "photo" else sent.document
+    await file_ids.set(key, uploaded.file_id)
+    return sent
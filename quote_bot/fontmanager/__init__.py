@@ -0,0 +1,3 @@
+from .fontmanager import font_cache, get_font, warm_up
+
+__all__ = ["get_font", "font_cache", "warm_up"]
@@ -0,0 +1,39 @@
+from os.path import getsize
+from typing import Iterable, Tuple
+
+from PIL import ImageFont
+
+from .. import metrics
+from ..cache import BoundedCache
+from ..settings import DesignerSettings
+
+# FreeType keeps the font file in memory, so the file size is a fair estimate of the object weight
+font_cache = BoundedCache(DesignerSettings.font_cache_size(), weight=lambda font: getsize(font.path))
+metrics.registry.register_stats("font", font_cache.stats)
+
+
+def get_font(path_to_font: str, size: int) -> ImageFont.FreeTypeFont:
+    """
+    Get Pillow font object
+    Cached function: each (font, size) pair is parsed once per process
+    :param path_to_font: path to .ttf font file
+    :param size: font size
+    """
+    return font_cache.get_or_set((path_to_font, size), lambda: _load_font(path_to_font, size))
+
+
+def _load_font(path_to_font: str, size: int) -> ImageFont.FreeTypeFont:
+    with metrics.stage("font_load"):
+        return ImageFont.truetype(path_to_font, size)
+
+
+def warm_up(fonts: Iterable[Tuple[str, int]]):
+    """
+    Load fonts into the cache in advance
+    :param fonts: pairs (path to .ttf font file, size)
+    """
+    for path_to_font, size in fonts:
+        get_font(path_to_font, size)
+
+
+warm_up(DesignerSettings.warm_fonts())
@@ -0,0 +1,4 @@
+from .queue import Job, JobQueue, MemoryQueue, create_queue
+from .worker import process_job, run_worker
+
+__all__ = ["Job", "JobQueue", "MemoryQueue", "create_queue", "process_job", "run_worker"]
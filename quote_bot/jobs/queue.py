@@ -0,0 +1,94 @@
+from asyncio import Queue, TimeoutError, get_event_loop, wait_for
+from itertools import count
+from typing import Dict, NamedTuple, Optional
+
+
+class Job(NamedTuple):
+    id: str  # Queue-specific handle, e.g. SQS receipt handle
+    payload: Dict
+    attempts: int  # Number of times the job was taken from the queue (this one included)
+
+
+class JobQueue:
+    """
+    Queue of jobs (JSON-serializable dicts). A job taken from the queue must be either done or released:
+    jobs that were neither (the worker died) are taken again after the visibility timeout
+    """
+
+    async def put(self, payload: Dict):
+        raise NotImplementedError()
+
+    async def get(self, timeout: float) -> Optional[Job]:
+        """
+        Take the next job
+        :param timeout: maximum wait time in seconds
+        :return: job or None if the queue stayed empty
+        """
+        raise NotImplementedError()
+
+    async def done(self, job: Job):
+        """
+        Remove finished job from the queue
+        """
+        raise NotImplementedError()
+
+    async def release(self, job: Job, delay: float = 0):
+        """
+        Return failed job to the queue to be taken again
+        :param delay: the job is not taken again until this time (in seconds) passes
+        """
+        raise NotImplementedError()
+
+
+class MemoryQueue(JobQueue):
+    """
+    In-process queue for local runs and tests: the bot and the worker share one event loop
+    """
+
+    def __init__(self):
+        self._queue: Optional[Queue] = None  # Created in the event loop of the first call
+        self._ids = count(1)
+
+    @property
+    def queue(self) -> Queue:
+        if self._queue is None:
+            self._queue = Queue()
+        return self._queue
+
+    async def put(self, payload: Dict):
+        self.queue.put_nowait(Job(str(next(self._ids)), payload, 0))
+
+    async def get(self, timeout: float) -> Optional[Job]:
+        try:
+            job = await wait_for(self.queue.get(), timeout)
+        except TimeoutError:
+            return None
+        return job._replace(attempts=job.attempts + 1)
+
+    async def done(self, job: Job):
+        pass
+
+    async def release(self, job: Job, delay: float = 0):
+        get_event_loop().call_later(delay, self.queue.put_nowait, job)
+
+
+def create_queue(url: str, visibility_timeout: int) -> Optional[JobQueue]:
+    """
+    Create job queue
+    :param url: "memory", "sqlite:///path/to/jobs.db", SQS queue URL "https://sqs..." or empty string (no queue)
+    :param visibility_timeout: jobs that were taken but neither done nor released are taken again after this time
+    :return: job queue or None
+    """
+    if not url:
+        return None
+    if url == "memory":
+        return MemoryQueue()
+    if url.startswith("sqlite://"):
+        from .sqlite import SQLiteQueue
+
+        return SQLiteQueue(url[len("sqlite://") :], visibility_timeout)
+    if url.startswith("https://sqs."):
+        from .sqs import SQSQueue  # boto3 is imported only if SQS is used
+
+        return SQSQueue(url, visibility_timeout)
+    raise ValueError(f"Unknown job queue {url}")
@@ -0,0 +1,83 @@
+import json
+import sqlite3
+from asyncio import get_event_loop, sleep
+from functools import partial
+from threading import Lock
+from time import monotonic, time
+from typing import Dict, Optional
+
+from .queue import Job, JobQueue
+
+
+class SQLiteQueue(JobQueue):
+    """
+    Job queue in a SQLite database, shared by the bot and local worker processes
+    """
+
+    _poll_interval = 0.2  # SQLite can not notify about new jobs, the queue is polled
+
+    def __init__(self, path: str, visibility_timeout: int):
+        """
+        :param path: database file
+        :param visibility_timeout: see create_queue
+        """
+        self._visibility_timeout = visibility_timeout
+        # Autocommit mode: transactions are started explicitly
+        self._connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self._lock = Lock()
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, visible_at REAL NOT NULL)"
+        )
+
+    async def _run(self, func, *args):
+        """
+        Run blocking database call out of the event loop
+        """
+        return await get_event_loop().run_in_executor(None, partial(func, *args))
+
+    def _execute(self, query: str, *args):
+        with self._lock:
+            self._connection.execute(query, args)
+
+    def _take(self) -> Optional[Job]:
+        now = time()
+        with self._lock:
+            # Write lock is taken right away: two workers never take the same job
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute(
+                    "SELECT id, payload, attempts FROM jobs WHERE visible_at <= ? ORDER BY id LIMIT 1", (now,)
+                ).fetchone()
+                if row is not None:
+                    self._connection.execute(
+                        "UPDATE jobs SET attempts = attempts + 1, visible_at = ? WHERE id = ?",
+                        (now + self._visibility_timeout, row[0]),
+                    )
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return Job(str(row[0]), json.loads(row[1]), row[2] + 1)
+
+    async def put(self, payload: Dict):
+        await self._run(
+            self._execute, "INSERT INTO jobs (payload, visible_at) VALUES (?, ?)", json.dumps(payload), time()
+        )
+
+    async def get(self, timeout: float) -> Optional[Job]:
+        deadline = monotonic() + timeout
+        while True:
+            job = await self._run(self._take)
+            if job is not None or monotonic() >= deadline:
+                return job
+            await sleep(self._poll_interval)
+
+    async def done(self, job: Job):
+        await self._run(self._execute, "DELETE FROM jobs WHERE id = ?", int(job.id))
+
+    async def release(self, job: Job, delay: float = 0):
+        await self._run(self._execute, "UPDATE jobs SET visible_at = ? WHERE id = ?", time() + delay, int(job.id))
@@ -0,0 +1,58 @@
+import json
+from asyncio import get_event_loop
+from functools import partial
+from typing import Dict, Optional
+
+import boto3
+
+from quote_bot.settings import BotSettings
+
+from .queue import Job, JobQueue
+
+
+class SQSQueue(JobQueue):
+    """
+    Amazon SQS job queue. On AWS Lambda jobs are delivered to the worker by the SQS trigger (see worker_handler),
+    get() is used by workers running elsewhere
+    """
+
+    def __init__(self, url: str, visibility_timeout: int):
+        """
+        :param url: queue URL
+        :param visibility_timeout: see create_queue
+        """
+        self._url = url
+        self._visibility_timeout = visibility_timeout
+        self._client = boto3.client("sqs", region_name=BotSettings.dynamo_region())
+
+    async def _run(self, method: str, **kwargs):
+        """
+        Run blocking boto3 call out of the event loop
+        """
+        return await get_event_loop().run_in_executor(
+            None, partial(getattr(self._client, method), QueueUrl=self._url, **kwargs)
+        )
+
+    async def put(self, payload: Dict):
+        await self._run("send_message", MessageBody=json.dumps(payload))
+
+    async def get(self, timeout: float) -> Optional[Job]:
+        response = await self._run(
+            "receive_message",
+            MaxNumberOfMessages=1,
+            WaitTimeSeconds=min(20, int(timeout)),  # Long polling, 20 seconds at most
+            VisibilityTimeout=self._visibility_timeout,
+            AttributeNames=["ApproximateReceiveCount"],
+        )
+        messages = response.get("Messages")
+        if not messages:
+            return None
+        message = messages[0]
+        attempts = int(message["Attributes"]["ApproximateReceiveCount"])
+        return Job(message["ReceiptHandle"], json.loads(message["Body"]), attempts)
+
+    async def done(self, job: Job):
+        await self._run("delete_message", ReceiptHandle=job.id)
+
+    async def release(self, job: Job, delay: float = 0):
+        await self._run("change_message_visibility", ReceiptHandle=job.id, VisibilityTimeout=int(delay))
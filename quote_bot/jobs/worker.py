@@ -0,0 +1,66 @@
+import logging
+from asyncio import Semaphore, ensure_future, sleep
+from typing import Awaitable, Callable, Dict
+
+from .queue import Job, JobQueue
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+async def process_job(
+    job: Job, queue: JobQueue, handler: Callable[[Dict], Awaitable], max_attempts: int, retry_delay: float = 0
+):
+    """
+    Process job and remove it from the queue. Failed job is returned to the queue until it fails MAX_ATTEMPTS times
+    :param retry_delay: failed job is taken again after this time (in seconds), doubled with every attempt
+    """
+    try:
+        await handler(job.payload)
+    except Exception:
+        if job.attempts < max_attempts:
+            logger.exception(f"Job {job.id} failed (attempt {job.attempts}), it will be retried")
+            await queue.release(job, retry_delay * 2 ** (job.attempts - 1))
+            return
+        logger.exception(f"Job {job.id} failed {job.attempts} times, dropped")
+    await queue.done(job)
+
+
+async def run_worker(
+    queue: JobQueue,
+    handler: Callable[[Dict], Awaitable],
+    concurrency: int,
+    max_attempts: int,
+    retry_delay: float = 0,
+    poll_timeout: float = 20,
+):
+    """
+    Take jobs from the queue and process them (until cancelled)
+    :param queue: job queue
+    :param handler: coroutine function processing job payload
+    :param concurrency: maximum number of jobs processed at the same time
+    :param max_attempts: see process_job
+    :param retry_delay: see process_job
+    :param poll_timeout: wait time of one queue request in seconds
+    """
+    slots = Semaphore(concurrency)
+
+    async def process(job: Job):
+        try:
+            await process_job(job, queue, handler, max_attempts, retry_delay)
+        finally:
+            slots.release()
+
+    while True:
+        await slots.acquire()  # Jobs are not taken while there is no slot to process them
+        try:
+            job = await queue.get(poll_timeout)
+        except Exception:
+            slots.release()
+            logger.exception("Job queue is not available")
+            await sleep(poll_timeout)
+            continue
+        if job is None:
+            slots.release()
+            continue
+        ensure_future(process(job))
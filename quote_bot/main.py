@@ -1,20 +1,71 @@
-from asyncio import get_event_loop
-from io import BytesIO
+import json
+import logging
+from asyncio import ensure_future, gather, get_event_loop
+from time import perf_counter, time
+from typing import TYPE_CHECKING, Dict, Optional
 
-import boto3
 from aiogram import Bot, Dispatcher, executor, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
-from aiogram.types import ContentType, InputFile
+from aiogram.types import ContentType
 
+from quote_bot import metrics
 from quote_bot.access import AccessMiddleware
 from quote_bot.access import public as public_command
+from quote_bot.dedup import DeduplicationMiddleware, UpdateLog
 from quote_bot.dynamo import DynamoStorage
-from quote_bot.settings import BotSettings
-from quote_bot.templates import TemplatesManager
+from quote_bot.fileids import answer_file
+from quote_bot.jobs import JobQueue, MemoryQueue, create_queue, run_worker
+from quote_bot.settings import BotSettings, DesignerSettings
 from quote_bot.utils import download_file
+from quote_bot.workers import RenderPool, RenderPoolBusy, UserRenderLimit
 
-templates_manager = TemplatesManager()
+if TYPE_CHECKING:
+    from quote_bot.templates import TemplatesManager
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Updates the bot handles: chat_member updates keep the membership index of the access chat up to date
+ALLOWED_UPDATES = (
+    types.AllowedUpdates.MESSAGE
+    + types.AllowedUpdates.CALLBACK_QUERY
+    + types.AllowedUpdates.CHAT_MEMBER
+    + types.AllowedUpdates.MY_CHAT_MEMBER
+)
+
+_templates_manager: Optional["TemplatesManager"] = None
+_render_pool: Optional[RenderPool] = None
+_job_queue: Optional[JobQueue] = None
+
+
+def get_templates_manager() -> "TemplatesManager":
+    """
+    Templates manager. Pillow, fonts and templates are loaded on first use, so cheap commands answer faster
+    """
+    global _templates_manager
+    if _templates_manager is None:
+        from quote_bot.templates import TemplatesManager
+
+        _templates_manager = TemplatesManager()
+    return _templates_manager
+
+
+def get_render_pool() -> RenderPool:
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = RenderPool(get_templates_manager(), BotSettings.render_executor(), BotSettings.render_workers())
+    return _render_pool
+
+
+def get_job_queue() -> Optional[JobQueue]:
+    """
+    Render jobs queue (None if posters are rendered while answering the update)
+    """
+    global _job_queue
+    if _job_queue is None and BotSettings.job_queue():
+        _job_queue = create_queue(BotSettings.job_queue(), BotSettings.job_visibility_timeout())
+    return _job_queue
 
 
 async def start(message: types.Message, state: FSMContext):
@@ -24,6 +75,7 @@ async def start(message: types.Message, state: FSMContext):
     async with state.proxy() as proxy:
         proxy.pop("template")  # Reset current user template
         proxy.pop("background")
+        proxy.pop("background_id")
         proxy.pop("text")
 
     await message.answer(
@@ -37,12 +89,12 @@ async def templates_list(message: types.Message):
     """
     Get templates list command handler
     """
-    templates = templates_manager.all_templates()
+    templates = get_templates_manager().all_templates()
 
     for name, template in templates.items():
         keyboard = types.InlineKeyboardMarkup()
         keyboard.add(types.InlineKeyboardButton(f"Выбрать {name}", callback_data=name))
-        await message.answer_photo(template.preview, reply_markup=keyboard)
+        await answer_file(message, "photo", f"preview:{template.preview_id}", template.preview, reply_markup=keyboard)
 
 
 @public_command()  # Everyone can call
@@ -55,16 +107,133 @@ async def get_chat_id(message: types.Message):
     await message.answer(message.chat.id)
 
 
-async def _go_template(message: types.Message, proxy, template_name: str):
+async def _render_poster(
+    message: types.Message,
+    proxy,
+    template_name: str,
+    profile: str,
+    key: str,
+    width: Optional[int] = None,
+    notice: Optional[str] = None,
+    queued: bool = False,
+) -> Optional[bytes]:
     """
-    Process quote and background...
+    Render poster or take it from the render cache
+    :param profile: output profile
+    :param key: render cache key, see RenderPool.render_key
+    :param width: poster width (None for the template size)
+    :param notice: message to send if the poster is not cached
+    :param queued: rendered by the job worker: if the bot is overloaded, the exception is raised to retry the job
+    :return: encoded image (None if the bot is overloaded or the background is bad)
     """
     text = proxy["text"]
-    await message.answer("Рисую плакат, ждите ... (до ~30 секунд)")
-    background = await download_file(proxy.get("background"))
-    png = templates_manager.process_template(template_name, text, background)
-    await message.answer_photo(png)
-    await message.answer_document(InputFile(BytesIO(png), filename=f"{template_name}_poster.png"))
+    # Backgrounds uploaded before file_unique_id was stored are identified by file_id
+    background_id = proxy.get("background_id") or proxy.get("background")
+    image = get_templates_manager().render_cache.get(key, profile)
+    if image is not None:
+        metrics.count("render_cache_hits")
+        return image
+
+    from quote_bot.designer import BackgroundTooLarge, BadBackground  # Loaded with templates manager anyway
+
+    try:
+        with get_render_pool().reserve(message.from_user.id):
+            if notice:
+                await message.answer(notice)
+            background = await download_file(proxy.get("background"), proxy.get("background_id"))
+            images = await get_render_pool().render(
+                template_name, text, background, background_id, (profile,), width, key
+            )
+            return images[profile]
+    except BackgroundTooLarge:
+        await message.answer("Картинка для фона слишком большая, отправьте картинку поменьше")
+    except BadBackground:
+        await message.answer("Не удалось открыть картинку для фона, отправьте другую")
+    except UserRenderLimit:
+        if queued:
+            raise
+        await message.answer("Дождитесь, пока будет готов предыдущий плакат")
+    except RenderPoolBusy:
+        if queued:
+            raise
+        await message.answer("Сейчас бот перегружен, попробуйте через минуту")
+    return None
+
+
+async def _go_template(message: types.Message, proxy, template_name: str):
+    """
+    Process quote and background: send small preview first (it is rendered in a fraction of time),
+    then the full size poster for print. With the job queue the poster for print is left to the worker,
+    and the update is answered right after the preview
+    """
+    queue = get_job_queue()
+    with metrics.trace("poster", template=template_name, background=bool(proxy.get("background"))):
+        preview = await _send_preview(message, proxy, template_name)
+        if preview and queue is None:
+            await _send_document(message, proxy, template_name)
+    if not preview or queue is None:
+        return
+
+    job = {
+        "message": message.to_python(),
+        "template": template_name,
+        "text": proxy["text"],
+        "background": proxy.get("background"),
+        "background_id": proxy.get("background_id"),
+        "enqueued": time(),
+    }
+    await queue.put(job)
+    metrics.count("jobs_enqueued")
+    await message.answer("Плакат для печати в очереди, скоро пришлю")
+
+
+async def process_render_job(job: Dict):
+    """
+    Render and send poster for print of the job queued by _go_template (in the worker)
+    """
+    message = types.Message.to_object(job["message"])
+    proxy = {name: job[name] for name in ("text", "background", "background_id")}
+    with metrics.trace("poster", template=job["template"], background=bool(job["background"])):
+        metrics.record("queue_wait", time() - job["enqueued"])
+        await _send_document(message, proxy, job["template"], queued=True)
+
+
+async def _send_preview(message: types.Message, proxy, template_name: str) -> Optional[types.Message]:
+    """
+    Send poster preview, rendered at the preview width from downscaled layers.
+    Posters already known to Telegram are sent by file_id without rendering
+    :return: sent message (None if the poster could not be rendered)
+    """
+    background_id = proxy.get("background_id") or proxy.get("background")
+    width = DesignerSettings.default_preview_width()
+    key = await get_render_pool().render_key(template_name, proxy["text"], background_id, width)
+    return await answer_file(
+        message, "photo", f"photo:{key}", lambda: _render_poster(message, proxy, template_name, "photo", key, width)
+    )
+
+
+async def _send_document(message: types.Message, proxy, template_name: str, queued: bool = False):
+    """
+    Send full size poster for print
+    :param queued: see _render_poster
+    """
+    background_id = proxy.get("background_id") or proxy.get("background")
+    key = await get_render_pool().render_key(template_name, proxy["text"], background_id)
+    await answer_file(
+        message,
+        "document",
+        f"document:{key}",
+        lambda: _render_poster(
+            message,
+            proxy,
+            template_name,
+            "document",
+            key,
+            notice="Рисую плакат для печати, ждите ... (до ~30 секунд)",
+            queued=queued,
+        ),
+        filename=f"{template_name}_poster.png",
+    )
 
 
 async def process_text(message: types.Message, state: FSMContext):
@@ -73,7 +242,7 @@ async def process_text(message: types.Message, state: FSMContext):
     """
     async with state.proxy() as proxy:
         template = proxy.get("template", None)
-        if not template or template not in templates_manager.all_templates():
+        if not template or template not in get_templates_manager().all_templates():
             await message.answer("Сначала выберите шаблон в меню /templates")
         else:
             proxy["text"] = message.text
@@ -87,14 +256,18 @@ async def process_image(message: types.Message, state: FSMContext):
     if "image" not in message.document.mime_type:
         await message.answer("Это не изображение")
         return
+    if message.document.file_size and message.document.file_size > BotSettings.max_background_file_size():
+        await message.answer("Файл слишком большой, отправьте картинку поменьше")
+        return
 
     async with state.proxy() as proxy:
         template = proxy.get("template")
-        if not template or template not in templates_manager.all_templates():
+        if not template or template not in get_templates_manager().all_templates():
             await message.answer("Сначала выберите шаблон в меню /templates")
             return
 
         proxy["background"] = message.document.file_id
+        proxy["background_id"] = message.document.file_unique_id
 
         if not proxy.get("text"):
             await message.answer("Фон загружен. Теперь отправьте текст для цитаты.")
@@ -117,11 +290,11 @@ async def process_callback(callback_query: types.CallbackQuery, state: FSMContex
     bot = Bot.get_current()
     await bot.answer_callback_query(callback_query.id)
     template = callback_query.data
-    if template not in templates_manager.all_templates():
+    if template not in get_templates_manager().all_templates():
         await bot.send_message(callback_query.from_user.id, "Такого шаблона не существует")
         return
 
-    size = templates_manager.all_templates()[template].pil_image.size
+    size = get_templates_manager().all_templates()[template].size
     await bot.send_message(
         callback_query.from_user.id,
         f"Выбран шаблон {template}, теперь отправьте текст для плаката.\n\n"
@@ -133,6 +306,7 @@ async def process_callback(callback_query: types.CallbackQuery, state: FSMContex
     async with state.proxy() as proxy:
         proxy["template"] = template
         proxy.pop("background")
+        proxy.pop("background_id")
         proxy.pop("text")
 
 
@@ -141,6 +315,13 @@ async def register_handlers(dp: Dispatcher):
     Registration all handlers before processing update
     """
 
+    # Set up first: repeated updates are dropped before any other work
+    if isinstance(dp.storage, DynamoStorage):
+        update_log = dp.storage
+    else:
+        update_log = UpdateLog(BotSettings.update_dedup_ttl(), BotSettings.update_dedup_size())
+    dp.middleware.setup(DeduplicationMiddleware(update_log))
+
     dp.register_message_handler(start, commands=["start"])
     dp.register_message_handler(templates_list, commands=["templates"])
     dp.register_message_handler(get_chat_id, commands=["chat_id"])
@@ -149,7 +330,9 @@ async def register_handlers(dp: Dispatcher):
     dp.register_message_handler(process_photo, content_types=[ContentType.PHOTO])
     dp.register_message_handler(process_image, content_types=[ContentType.DOCUMENT])
 
-    dp.middleware.setup(AccessMiddleware(BotSettings.access_chat_id()))
+    access = AccessMiddleware(BotSettings.access_chat_id())
+    access.register_handlers(dp)
+    dp.middleware.setup(access)
 
 
 async def process_event(event, dp: Dispatcher):
@@ -159,8 +342,35 @@ async def process_event(event, dp: Dispatcher):
     """
 
     Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
     update = types.Update.to_object(event)
-    await dp.process_update(update)
+    dp.storage.begin_update()
+    try:
+        await dp.process_updates([update])  # Unlike process_update, triggers update middlewares
+    finally:
+        # Changes made before a handler failed (template, text, background) are saved too
+        await dp.storage.flush()
+
+
+_aws_dispatcher: Optional[Dispatcher] = None
+
+
+async def _get_aws_dispatcher() -> Dispatcher:
+    """
+    Bot and dispatcher initialization. Warm AWS Lambda containers reuse them (with HTTP session and DynamoDB table)
+    """
+    global _aws_dispatcher
+    if _aws_dispatcher is None:
+        bot = Bot(BotSettings.token())
+
+        import boto3  # Slow import, only AWS Lambda needs it
+
+        dynamodb = boto3.resource("dynamodb", region_name=BotSettings.dynamo_region())
+        dp = Dispatcher(bot, storage=DynamoStorage(dynamodb))
+
+        await register_handlers(dp)
+        _aws_dispatcher = dp
+    return _aws_dispatcher
 
 
 async def aws_main(event):
@@ -169,15 +379,23 @@ async def aws_main(event):
     and launching subsequent functions
     """
 
-    # Bot and dispatcher initialization
-    bot = Bot(BotSettings.token())
+    cold = _aws_dispatcher is None
+    start_time = perf_counter()
+    dp = await _get_aws_dispatcher()
+    init_time = perf_counter()
 
-    dynamodb = boto3.resource("dynamodb", region_name=BotSettings.dynamo_region())
-    dp = Dispatcher(bot, storage=DynamoStorage(dynamodb))
-
-    await register_handlers(dp)
     await process_event(event, dp)
 
+    logger.info(
+        json.dumps(
+            {
+                "event": "invocation",
+                "cold": cold,
+                "init_ms": round((init_time - start_time) * 1000, 1),
+                "process_ms": round((perf_counter() - init_time) * 1000, 1),
+            }
+        )
+    )
     return "ok"
 
 
@@ -189,6 +407,71 @@ def lambda_handler(event, context):
     return get_event_loop().run_until_complete(aws_main(event))
 
 
+async def _process_job_record(record: Dict) -> bool:
+    """
+    Process render job from SQS event record
+    :return: False if the job failed
+    """
+    storage = Dispatcher.get_current().storage
+    storage.begin_update()
+    try:
+        await process_render_job(json.loads(record["body"]))
+        return True
+    except Exception:
+        logger.exception(f"Render job {record['messageId']} failed")
+        return False
+    finally:
+        await storage.flush()
+
+
+async def aws_worker_main(event) -> Dict:
+    dp = await _get_aws_dispatcher()
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    results = await gather(*(_process_job_record(record) for record in event["Records"]))
+    # Partial batch response: only failed jobs are returned to the queue (ReportBatchItemFailures must be enabled)
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": record["messageId"]} for record, ok in zip(event["Records"], results) if not ok
+        ]
+    }
+
+
+def worker_handler(event, context):
+    """
+    AWS Lambda handler of the render worker (SQS trigger of the JOB_QUEUE queue)
+    """
+
+    return get_event_loop().run_until_complete(aws_worker_main(event))
+
+
+def start_job_worker(dp: Dispatcher):
+    """
+    Process render jobs in the current event loop
+    """
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    return ensure_future(
+        run_worker(
+            get_job_queue(),
+            process_render_job,
+            BotSettings.render_workers(),
+            BotSettings.job_max_attempts(),
+            BotSettings.job_retry_delay(),
+        )
+    )
+
+
+def worker_main():
+    """
+    Render worker for the bot in polling mode with a SQLite (or SQS) job queue
+    """
+    if get_job_queue() is None:
+        raise ValueError("Job queue must be specified (JOB_QUEUE environment variable)")
+    dp = Dispatcher(Bot(BotSettings.token()), storage=MemoryStorage())
+    get_event_loop().run_until_complete(start_job_worker(dp))
+
+
 def main():
     """
     Classic polling
@@ -196,7 +479,14 @@ def main():
     bot = Bot(BotSettings.token())
     dp = Dispatcher(bot, storage=MemoryStorage())
     get_event_loop().run_until_complete((register_handlers(dp)))
-    executor.start_polling(dp, skip_updates=True)
+    if BotSettings.metrics_port():
+        get_event_loop().run_until_complete(metrics.start_server(BotSettings.metrics_port()))
+
+    async def on_startup(dp: Dispatcher):
+        if isinstance(get_job_queue(), MemoryQueue):  # In-process queue is processed by the bot process itself
+            start_job_worker(dp)
+
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
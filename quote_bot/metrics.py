@@ -0,0 +1,205 @@
+import json
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class Trace:
+    """
+    Stage timings and counters of one request (e.g. one poster)
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, float] = dict()  # stage -> seconds
+        self.counters: Dict[str, int] = dict()
+        self._lock = Lock()  # Stages of one poster may run in several threads (output encoders)
+
+    def add_stage(self, name: str, seconds: float):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_counter(self, name: str, value: int):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, data: Dict[str, Dict]):
+        """
+        Add stages and counters of another trace, see to_dict
+        """
+        for name, seconds in data["stages"].items():
+            self.add_stage(name, seconds)
+        for name, value in data["counters"].items():
+            self.add_counter(name, value)
+
+    def to_dict(self) -> Dict[str, Dict]:
+        return {"stages": dict(self.stages), "counters": dict(self.counters)}
+
+
+class Registry:
+    """
+    Process-wide totals of all traces (exported in Prometheus text format)
+    """
+
+    def __init__(self):
+        self._stages: Dict[str, list] = dict()  # stage -> [count, seconds]
+        self._counters: Dict[str, int] = dict()
+        self._stats: Dict[str, Callable[[], Dict]] = dict()
+        self._lock = Lock()
+
+    def add_stage(self, name: str, seconds: float):
+        with self._lock:
+            total = self._stages.setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += seconds
+
+    def add_counter(self, name: str, value: int):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def add_trace(self, trace: Trace):
+        for name, seconds in trace.stages.items():
+            self.add_stage(name, seconds)
+        for name, value in trace.counters.items():
+            self.add_counter(name, value)
+
+    def register_stats(self, name: str, stats: Callable[[], Dict]):
+        """
+        Export cache statistics as gauges
+        :param name: cache name
+        :param stats: stats() method of the cache: Dict[stat, value] or Dict[tier, Dict[stat, value]]
+        """
+        self._stats[name] = stats
+
+    def prometheus(self) -> str:
+        lines = ["# TYPE quote_bot_stage_seconds summary"]
+        with self._lock:
+            for name, (count, seconds) in sorted(self._stages.items()):
+                lines.append(f'quote_bot_stage_seconds_count{{stage="{name}"}} {count}')
+                lines.append(f'quote_bot_stage_seconds_sum{{stage="{name}"}} {seconds:.6f}')
+            lines.append("# TYPE quote_bot_events_total counter")
+            for name, value in sorted(self._counters.items()):
+                lines.append(f'quote_bot_events_total{{event="{name}"}} {value}')
+
+        lines.append("# TYPE quote_bot_cache gauge")
+        for cache, stats in sorted(self._stats.items()):
+            stats = stats()
+            tiers = stats if all(isinstance(value, dict) for value in stats.values()) else {"memory": stats}
+            for tier, values in tiers.items():
+                for stat, value in values.items():
+                    lines.append(f'quote_bot_cache{{cache="{cache}",tier="{tier}",stat="{stat}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Trace of the request being processed (None outside of traced requests)
+_trace: ContextVar[Optional[Trace]] = ContextVar("metrics_trace", default=None)
+
+
+def record(name: str, seconds: float):
+    """
+    Record stage timing in the current trace (or right in the registry outside of traces)
+    """
+    trace = _trace.get()
+    (trace or registry).add_stage(name, seconds)
+
+
+def count(name: str, value: int = 1):
+    """
+    Increment counter in the current trace (or right in the registry outside of traces)
+    """
+    trace = _trace.get()
+    (trace or registry).add_counter(name, value)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Measure stage time
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        record(name, perf_counter() - start)
+
+
+@contextmanager
+def trace(event: str, **fields):
+    """
+    Trace a request: stages and counters are added to the registry and logged as one JSON line
+    :param event: event name, e.g. "render"
+    :param fields: additional log fields
+    """
+    current = Trace()
+    token = _trace.set(current)
+    start = perf_counter()
+    try:
+        yield current
+    finally:
+        _trace.reset(token)
+        total = perf_counter() - start
+        current.add_stage(event, total)
+        registry.add_trace(current)
+        logger.info(
+            json.dumps(
+                {
+                    "event": event,
+                    **fields,
+                    "total_ms": round(total * 1000, 1),
+                    "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in current.stages.items()},
+                    "counters": current.counters,
+                }
+            )
+        )
+
+
+@contextmanager
+def collect():
+    """
+    Collect stages and counters without logging them, e.g. in a worker process.
+    Pass Trace.to_dict() to the parent process and merge() it there
+    """
+    current = Trace()
+    token = _trace.set(current)
+    try:
+        yield current
+    finally:
+        _trace.reset(token)
+
+
+def merge(data: Dict[str, Dict]):
+    """
+    Add stages and counters collected by collect() to the current trace (or to the registry)
+    """
+    current = _trace.get()
+    if current is not None:
+        current.merge(data)
+    else:
+        current = Trace()
+        current.merge(data)
+        registry.add_trace(current)
+
+
+async def start_server(port: int):
+    """
+    Serve metrics in Prometheus text format on http://0.0.0.0:PORT/metrics
+    """
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=registry.prometheus(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    logger.info(f"Metrics are served on port {port}")
+    return runner
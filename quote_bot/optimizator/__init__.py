@@ -1,3 +1,4 @@
+from .layout import measurement_cache
 from .optimizator import optimize_font_size
 
-__all__ = ["optimize_font_size"]
+__all__ = ["optimize_font_size", "measurement_cache"]
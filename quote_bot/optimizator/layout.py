@@ -0,0 +1,131 @@
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Tuple
+
+from .. import metrics
+from ..bundle import load_bundle
+from ..cache import BoundedCache
+from ..fontmanager import get_font
+from ..settings import DesignerSettings
+
+# Pillow inserts this many pixels between lines of multiline text (ImageDraw.multiline_textsize default)
+LINE_SPACING = 4
+
+# Text measurements keyed by content only (font path, size, text, wrap width), shared by all requests
+measurement_cache = BoundedCache(
+    DesignerSettings.measurement_cache_size(), ttl=DesignerSettings.measurement_cache_ttl()
+)
+metrics.registry.register_stats("measurement", measurement_cache.stats)
+
+
+class FontMetrics:
+    """
+    Glyph metrics of a font measured once at the reference size.
+    Sizes at any other font size are scaled linearly, so layout probes do not touch FreeType
+    """
+
+    reference_size: int = 100
+
+    def __init__(self, path_to_font: str, table: Optional[Dict] = None):
+        """
+        Load font metrics
+        :param path_to_font: path to .ttf font file
+        :param table: metrics measured in advance, see table()
+        """
+        self._path = path_to_font
+        # Words of the table never expire, other words are measured and kept in measurement_cache
+        self._words: Dict[str, Tuple[int, int]] = {}
+        if table and table["reference_size"] == self.reference_size:
+            self._line_height = table["line_height"]
+            self._space = table["space"]
+            self._words = {word: tuple(size) for word, size in table["words"].items()}
+        else:
+            # Pillow measures the height of multiline text by the letter "A"
+            self._line_height = self._font.getsize("A")[1]
+            self._space = self._font.getsize(" ")[0]
+
+    @property
+    def _font(self):
+        return get_font(self._path, self.reference_size)
+
+    def table(self, words: Iterable[str]) -> Dict:
+        """
+        Metrics table to save and load later without measuring
+        :param words: words to measure
+        """
+        return {
+            "reference_size": self.reference_size,
+            "line_height": self._line_height,
+            "space": self._space,
+            "words": {word: self._word_size(word) for word in sorted(words)},
+        }
+
+    def _word_size(self, word: str) -> Tuple[int, int]:
+        """
+        Word size (width, height) at the reference size
+        """
+        size = self._words.get(word)
+        if size is not None:
+            return size
+        return measurement_cache.get_or_set(
+            ("word", self._path, self.reference_size, word), lambda: self._font.getsize(word)
+        )
+
+    def _line_size(self, line: str) -> Tuple[int, int]:
+        """
+        Line size (width, height) at the reference size
+        """
+        words = line.split(" ")
+        sizes = [self._word_size(word) for word in words if word]
+        width = sum(size[0] for size in sizes) + self._space * (len(words) - 1)
+        height = max((size[1] for size in sizes), default=0)
+        return width, height
+
+    def _reference_size(self, wrapped_text: str) -> Tuple[int, int, int]:
+        """
+        Text size at the reference size
+        :return: Tuple[width without spacing, height without spacing, lines count]
+        """
+        lines = wrapped_text.split("\n")
+        sizes = [self._line_size(line) for line in lines]
+        width = max(size[0] for size in sizes)
+        if len(lines) == 1:
+            return width, sizes[0][1], 1
+        return width, self._line_height * len(lines), len(lines)
+
+    def text_size(self, wrapped_text: str, font_size: int) -> Tuple[float, float]:
+        """
+        Estimate text size like ImageDraw.textsize does
+        :param wrapped_text: text with \n symbols
+        :param font_size: font size
+        :return: Tuple[width, height] in px
+        """
+        width, height, lines = self._reference_size(wrapped_text)
+        scale = font_size / self.reference_size
+        return width * scale, height * scale + LINE_SPACING * (lines - 1)
+
+    def max_font_size(self, wrapped_text: str, max_width: int, max_height: int) -> int:
+        """
+        Biggest font size at which the text fits into the rectangle
+        :param wrapped_text: text with \n symbols
+        :param max_width: rectangle width in px
+        :param max_height: rectangle height in px
+        :return: font size (0 if the text never fits)
+        """
+        width, height, lines = self._reference_size(wrapped_text)
+        max_height -= LINE_SPACING * (lines - 1)
+        if max_height <= 0:
+            return 0
+
+        by_width = max_width * self.reference_size / width if width else float("inf")
+        by_height = max_height * self.reference_size / height if height else float("inf")
+        return int(min(by_width, by_height, 10000))
+
+
+@lru_cache(maxsize=None)
+def font_metrics(path_to_font: str) -> FontMetrics:
+    """
+    Get metrics of the font (each font is loaded once per process)
+    :param path_to_font: path to .ttf font file
+    """
+    bundle = load_bundle()
+    return FontMetrics(path_to_font, bundle.font_metrics(path_to_font) if bundle else None)
@@ -1,8 +1,14 @@
 import textwrap
-from functools import lru_cache
 from typing import Callable, Optional, Tuple
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
+
+from .. import metrics
+from ..fontmanager import get_font
+from .layout import font_metrics, measurement_cache
+
+# Text size does not depend on the image, so one drawer is enough for the final checks
+_drawer = ImageDraw.Draw(Image.new("1", (1, 1)))
 
 
 def _wrap_word(text: str, w: int) -> str:
@@ -15,55 +21,11 @@ def _wrap_word(text: str, w: int) -> str:
     return "\n".join(textwrap.wrap(text, w, replace_whitespace=False, break_long_words=False))
 
 
-@lru_cache()
-def _font_target(
-    font_size: int,
-    max_width: int,
-    max_height: int,
-    wrapped_text: str,
-    path_to_font: str,
-    drawer,
-    max_font: Optional[int] = None,
-) -> int:
-    """
-    Minimize me!
-    :param font_size:
-    :param drawer:
-    :return:
-    """
-    font = ImageFont.truetype(path_to_font, font_size)
-
-    text_width, text_height = drawer.textsize(wrapped_text, font)
-
-    if text_width > max_width or text_height > max_height:
-        # Font is TOO big: minimize
-        return 100000
-
-    if max_font and font_size > max_font:
-        # Font is TOO big: minimize
-        return 100000
-
-    return -font_size  # Font size must be biggest
-
-
-@lru_cache()
-def _wrap_target(drawer, max_width: int, max_height: int, text: str, font, max_text_len: int):
-    """
-    Minimize me!
-    """
-    dim = max_width / max_height
-    wrapped = _wrap_word(text, max_text_len)
-    text_width, text_height = drawer.textsize(wrapped, font)
-    real_dim = text_width / text_height
-
-    return real_dim - dim
-
-
 def sign(x):
     return 1 if x >= 0 else -1
 
 
-def _bisect(target: Callable[[int], int], start: int, end: int) -> int:
+def _bisect(target: Callable[[int], float], start: int, end: int) -> int:
     """
     Integer bisect search
     find zero of TARGET (or closest to zero value)
@@ -102,6 +64,18 @@ def _bisect(target: Callable[[int], int], start: int, end: int) -> int:
         return right
 
 
+def _fits(wrapped_text: str, font_path: str, font_size: int, max_width: int, max_height: int) -> bool:
+    """
+    Check with Pillow that the text fits into the rectangle
+    """
+    metrics.count("optimizer_checks")
+    text_width, text_height = measurement_cache.get_or_set(
+        ("size", font_path, font_size, wrapped_text),
+        lambda: _drawer.textsize(wrapped_text, get_font(font_path, font_size)),
+    )
+    return text_width <= max_width and text_height <= max_height
+
+
 def optimize_font_size(
     max_width: int, max_height: int, text: str, font_path: str, max_font: Optional[int] = None
 ) -> Tuple[int, str]:
@@ -114,34 +88,46 @@ def optimize_font_size(
     :param max_font: maximum font size
     :return: Tuple[font size, wrapped text (with \n symbols)]
     """
-    image = Image.new("1", (max_width + 1, max_height + 1))
-    draw = ImageDraw.Draw(image)
+    with metrics.stage("layout"):
+        return measurement_cache.get_or_set(
+            ("layout", font_path, max_font, text, max_width, max_height),
+            lambda: _optimize_font_size(max_width, max_height, text, font_path, max_font),
+        )
 
-    font = ImageFont.truetype(font_path, 40)
 
-    def wrap_target(x):
+def _optimize_font_size(
+    max_width: int, max_height: int, text: str, font_path: str, max_font: Optional[int] = None
+) -> Tuple[int, str]:
+    font = font_metrics(font_path)
+    dim = max_width / max_height
+
+    def font_size(wrapped: str) -> int:
+        size = font.max_font_size(wrapped, max_width, max_height)
+        return min(size, max_font) if max_font else size
+
+    def aspect_error(wrapped: str) -> float:
+        text_width, text_height = font.text_size(wrapped, font.reference_size)
+        return text_width / text_height - dim if text_height else 0
+
+    def wrap_target(x: int) -> float:
         """
         Minimize me!
         :param x: max text line length
         """
-        res = _wrap_target(draw, max_width, max_height, text, font, x)
-        return res
+        metrics.count("optimizer_probes")
+        return aspect_error(_wrap_word(text, x))
 
-    # Optimize word wrapping
+    # Optimize word wrapping: the closest aspect ratio is a good guess, the best wrap is usually around it
     if text.count(" "):  # We don't need hyphenation if here are no tabs
-        wrap = _bisect(wrap_target, 1, 200)
+        guess = _bisect(wrap_target, 1, 200)
+        candidates = {_wrap_word(text, w) for w in range(max(guess - 5, 1), guess + 6)}
+        wrapped_text = max(candidates, key=lambda wrapped: (font_size(wrapped), -abs(aspect_error(wrapped))))
     else:
-        wrap = 1000
-
-    def font_target(x):
-        """
-        Minimize me!
-        :param x: font size
-        """
-        res = _font_target(x, max_width, max_height, _wrap_word(text, wrap), font_path, draw, max_font)
-        return res
+        wrapped_text = _wrap_word(text, 1000)
 
-    # Optimize font size
-    font_size = _bisect(font_target, 40, 1000)
+    # Optimize font size: linear estimation, then make sure Pillow agrees
+    size = max(font_size(wrapped_text), 1)
+    while size > 1 and not _fits(wrapped_text, font_path, size, max_width, max_height):
+        size -= 1
 
-    return font_size, _wrap_word(text, wrap)
+    return size, wrapped_text
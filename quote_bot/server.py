@@ -0,0 +1,205 @@
+"""
+Self-hosted webhook server: aiohttp front process and pre-forked bot workers.
+Updates of one user always go to the same worker, so FSM state stays in the MemoryStorage of that worker.
+Members joining or leaving the access chat are announced to all workers, each keeps its own privileges cache.
+Templates, fonts and the morphology dictionary are loaded before the fork and shared by all workers.
+
+Run behind a reverse proxy with TLS:
+    WEBHOOK_URL=https://bot.example.com/webhook WEBHOOK_SECRET=<secret> poetry run server
+"""
+
+import json
+import logging
+import os
+import signal
+from asyncio import ensure_future, gather, get_event_loop, new_event_loop, set_event_loop, sleep
+from concurrent.futures import ThreadPoolExecutor
+from hmac import compare_digest
+from multiprocessing import get_context
+from typing import Dict
+from urllib.parse import urlparse
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot import api
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiohttp import web
+
+from quote_bot import metrics
+from quote_bot.jobs import MemoryQueue
+from quote_bot.main import ALLOWED_UPDATES, get_job_queue, get_templates_manager, register_handlers, start_job_worker
+from quote_bot.settings import BotSettings
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def update_user_id(update: Dict) -> int:
+    """
+    Id of the user (or the chat) the update came from
+    :param update: update as sent by Telegram
+    """
+    for value in update.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("chat") or value.get("message", {}).get("chat")
+            if sender:
+                return sender["id"]
+    return 0
+
+
+def is_membership_update(update: Dict) -> bool:
+    """
+    Chat member update or service message about members joining or leaving a chat.
+    It may come from the user who added or removed members, not from the members themselves
+    :param update: update as sent by Telegram
+    """
+    if "chat_member" in update:
+        return True
+    message = update.get("message") or {}
+    return "new_chat_members" in message or "left_chat_member" in message
+
+
+async def _close_session(bot: Bot):
+    session = bot.session  # Newer aiogram versions create it on the first request only
+    if session is not None:
+        await session.close()
+
+
+async def _process_update(dp: Dispatcher, update: Dict):
+    try:
+        await dp.process_updates([types.Update.to_object(update)])
+    except Exception:
+        logger.exception(f"Update {update.get('update_id')} failed")
+
+
+async def _consume(dp: Dispatcher, updates):
+    """
+    Process updates routed to the worker until None is received
+    """
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    reader = ThreadPoolExecutor(1)  # Blocking multiprocessing queue is read out of the event loop
+    tasks = set()
+    while True:
+        update = await get_event_loop().run_in_executor(reader, updates.get)
+        if update is None:
+            break
+        task = ensure_future(_process_update(dp, update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await gather(*tasks)
+    await _close_session(dp.bot)
+
+
+def _worker(index: int, updates):
+    """
+    Bot worker process
+    :param index: worker number
+    :param updates: multiprocessing queue of updates (dicts) routed to the worker
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The front process stops workers with None
+    loop = new_event_loop()
+    set_event_loop(loop)
+
+    dp = Dispatcher(Bot(BotSettings.token()), storage=MemoryStorage())
+    loop.run_until_complete(register_handlers(dp))
+    if BotSettings.metrics_port():
+        loop.run_until_complete(metrics.start_server(BotSettings.metrics_port() + index))
+    if isinstance(get_job_queue(), MemoryQueue):  # In-process queue is processed by the worker itself
+        start_job_worker(dp)
+    loop.run_until_complete(_consume(dp, updates))
+
+
+async def _handle_update(request: web.Request) -> web.Response:
+    secret = BotSettings.webhook_secret()
+    if not compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), secret):
+        raise web.HTTPForbidden()
+    try:
+        update = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="Update must be a JSON object")
+    if not isinstance(update, dict):
+        raise web.HTTPBadRequest(text="Update must be a JSON object")
+
+    queues = request.app["queues"]
+    if is_membership_update(update):
+        for queue in queues:
+            queue.put(update)
+    else:
+        queues[update_user_id(update) % len(queues)].put(update)
+    return web.Response()  # Telegram gets the answer right away, the worker processes the update
+
+
+async def _watch_workers(app: web.Application):
+    """
+    Stop the server if a worker died (its users would not be answered), so the supervisor restarts it
+    """
+    while True:
+        await sleep(5)
+        dead = [process.name for process in app["processes"] if not process.is_alive()]
+        if dead:
+            logger.error(f"Workers {', '.join(dead)} died, stopping the server")
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+
+
+async def _on_startup(app: web.Application):
+    bot = Bot(BotSettings.token())
+    webhook = {
+        "url": BotSettings.webhook_url(),
+        "secret_token": BotSettings.webhook_secret(),
+        "allowed_updates": json.dumps(ALLOWED_UPDATES),
+    }
+    await bot.request(api.Methods.SET_WEBHOOK, webhook)  # set_webhook of older aiogram versions has no secret_token
+    await _close_session(bot)
+    app["watchdog"] = ensure_future(_watch_workers(app))
+
+
+async def _on_cleanup(app: web.Application):
+    app["watchdog"].cancel()
+    for queue in app["queues"]:
+        queue.put(None)
+    for process in app["processes"]:
+        process.join(timeout=30)  # Updates in progress are finished
+
+
+def _warm_up():
+    """
+    Load templates, fonts and the morphology dictionary and render a poster before the fork,
+    so workers share them (copy-on-write) and answer the first user fast
+    """
+    get_templates_manager().warm_up()
+
+
+def main():
+    if not BotSettings.webhook_url():
+        raise ValueError("Webhook URL must be specified (WEBHOOK_URL environment variable)")
+    if not BotSettings.webhook_secret():
+        raise ValueError("Webhook secret must be specified (WEBHOOK_SECRET environment variable)")
+    # Workers render in their own threads, one poster at a time: throughput scales with SERVER_WORKERS.
+    # Render processes can not be used: workers are daemonic and can not have child processes
+    if os.environ.setdefault("RENDER_EXECUTOR", "thread") != "thread":
+        raise ValueError("Only thread render executor can be used by the server (RENDER_EXECUTOR=thread)")
+    os.environ.setdefault("RENDER_WORKERS", "1")
+
+    _warm_up()
+
+    context = get_context("fork")
+    queues = [context.Queue() for _ in range(BotSettings.server_workers())]
+    processes = [
+        context.Process(target=_worker, args=(index, queue), name=f"quote-bot-worker-{index}", daemon=True)
+        for index, queue in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+
+    app = web.Application()
+    app["queues"] = queues
+    app["processes"] = processes
+    app.router.add_post(urlparse(BotSettings.webhook_url()).path or "/", _handle_update)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    web.run_app(app, host=BotSettings.server_host(), port=BotSettings.server_port())
+
+
+if __name__ == "__main__":
+    main()
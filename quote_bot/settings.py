@@ -1,6 +1,6 @@
 import os
 from os.path import abspath, dirname, join
-from typing import Tuple
+from typing import List, Optional, Tuple
 
 from dotenv import load_dotenv
 
@@ -24,12 +24,165 @@ class BotSettings:
 
     @classmethod
     def access_cache_ttl(cls) -> int:
-        return 60  # in seconds
+        # Chat members checked with get_chat_member are checked again after this time (in seconds)
+        return int(os.getenv("ACCESS_CACHE_TTL", 60))
+
+    @classmethod
+    def access_event_ttl(cls) -> int:
+        # Privileges known from membership events of the access chat are trusted for this time (in seconds):
+        # the next event updates them right away
+        return int(os.getenv("ACCESS_EVENT_TTL", 7 * 24 * 60 * 60))
+
+    @classmethod
+    def access_negative_cache_ttl(cls) -> int:
+        # Users without access are checked again after this time (in seconds)
+        return int(os.getenv("ACCESS_NEGATIVE_CACHE_TTL", 10))
+
+    @classmethod
+    def access_stale_ttl(cls) -> int:
+        # Stale privileges of chat members are used while they are checked again in background (in seconds)
+        return int(os.getenv("ACCESS_STALE_TTL", 60 * 60))
+
+    @classmethod
+    def access_memory_ttl(cls) -> int:
+        # Privileges are read from the shared storage again after this time (in seconds):
+        # a member who left loses access in all processes at most this time later
+        return int(os.getenv("ACCESS_MEMORY_TTL", 5))
+
+    @classmethod
+    def access_admins_ttl(cls) -> int:
+        # Administrators of the access chat are loaded again after this time (in seconds)
+        return int(os.getenv("ACCESS_ADMINS_TTL", 10 * 60))
+
+    @classmethod
+    def access_cache_size(cls) -> int:
+        # Maximum number of users in the in-process privileges cache
+        return int(os.getenv("ACCESS_CACHE_SIZE", 10000))
 
     @classmethod
     def dynamo_region(cls) -> str:
         return "us-east-1"
 
+    @classmethod
+    def file_ids_limit(cls) -> int:
+        # file_id of uploaded posters and previews kept in memory (all of them are in the storage, one item per file)
+        return int(os.getenv("FILE_IDS_LIMIT", 1000))
+
+    @classmethod
+    def file_ids_ttl(cls) -> int:
+        # file_id of a poster is kept in the storage for this time (in seconds), DynamoDB deletes it afterwards
+        return int(os.getenv("FILE_IDS_TTL", 30 * 24 * 60 * 60))
+
+    @classmethod
+    def update_dedup_ttl(cls) -> int:
+        # Telegram re-sends updates that were not answered in time: repeats are dropped for this time (in seconds)
+        return int(os.getenv("UPDATE_DEDUP_TTL", 5 * 60))
+
+    @classmethod
+    def update_dedup_size(cls) -> int:
+        # Maximum number of remembered update ids in polling mode
+        return int(os.getenv("UPDATE_DEDUP_SIZE", 10000))
+
+    @classmethod
+    def max_background_file_size(cls) -> int:
+        # Bot API does not download files bigger than 20 MB
+        return int(os.getenv("MAX_BACKGROUND_FILE_SIZE", 20 * 1024 * 1024))
+
+    @classmethod
+    def background_cache_size(cls) -> int:
+        # Memory limit of downloaded backgrounds cache in bytes
+        return int(os.getenv("BACKGROUND_CACHE_SIZE", 32 * 1024 * 1024))
+
+    @classmethod
+    def background_cache_ttl(cls) -> int:
+        return int(os.getenv("BACKGROUND_CACHE_TTL", 60 * 60))  # in seconds
+
+    @classmethod
+    def background_cache_dir(cls) -> Optional[str]:
+        # Directory of downloaded backgrounds disk cache. Disabled by default, /tmp on AWS Lambda
+        default = "/tmp/quote-bot/backgrounds" if os.getenv("AWS_LAMBDA_FUNCTION_NAME") else None
+        return os.getenv("BACKGROUND_CACHE_DIR", default)
+
+    @classmethod
+    def background_cache_disk_size(cls) -> int:
+        # Disk limit of downloaded backgrounds cache in bytes
+        return int(os.getenv("BACKGROUND_CACHE_DISK_SIZE", 128 * 1024 * 1024))
+
+    @classmethod
+    def metrics_port(cls) -> Optional[int]:
+        # Port of Prometheus metrics endpoint in polling mode (disabled by default)
+        port = os.getenv("METRICS_PORT")
+        return int(port) if port else None
+
+    @classmethod
+    def job_queue(cls) -> str:
+        # Render jobs queue: "memory" (worker in the bot process), "sqlite:///path/to/jobs.db" (local worker process),
+        # SQS queue URL (worker Lambda) or empty string (the bot renders posters while answering the update)
+        queue = os.getenv("JOB_QUEUE", "")
+        if queue and os.getenv("AWS_LAMBDA_FUNCTION_NAME") and not queue.startswith("https://sqs."):
+            # Lambda instance is frozen after the answer and may never run again: its local jobs would be lost
+            raise ValueError(f"Only SQS job queue can be used on AWS Lambda, not {queue}")
+        return queue
+
+    @classmethod
+    def job_visibility_timeout(cls) -> int:
+        # Job taken by a worker that died is taken again after this time (in seconds)
+        return int(os.getenv("JOB_VISIBILITY_TIMEOUT", 2 * 60))
+
+    @classmethod
+    def job_max_attempts(cls) -> int:
+        # Jobs of a user that is already waiting for a poster are retried too, so there are several attempts
+        return int(os.getenv("JOB_MAX_ATTEMPTS", 5))
+
+    @classmethod
+    def job_retry_delay(cls) -> float:
+        # Failed job is retried after this time (in seconds), doubled with every attempt
+        return float(os.getenv("JOB_RETRY_DELAY", 5))
+
+    @classmethod
+    def webhook_url(cls) -> Optional[str]:
+        # Public URL of the self-hosted webhook server, e.g. https://bot.example.com/webhook
+        return os.getenv("WEBHOOK_URL")
+
+    @classmethod
+    def webhook_secret(cls) -> Optional[str]:
+        # Required by the server: Telegram sends it in the X-Telegram-Bot-Api-Secret-Token header,
+        # updates without it are rejected
+        return os.getenv("WEBHOOK_SECRET")
+
+    @classmethod
+    def server_host(cls) -> str:
+        return os.getenv("SERVER_HOST", "127.0.0.1")  # Behind a reverse proxy with TLS
+
+    @classmethod
+    def server_port(cls) -> int:
+        return int(os.getenv("SERVER_PORT", 8080))
+
+    @classmethod
+    def server_workers(cls) -> int:
+        # Bot processes of the webhook server
+        return int(os.getenv("SERVER_WORKERS", os.cpu_count() or 1))
+
+    @classmethod
+    def render_executor(cls) -> str:
+        # "process" or "thread". AWS Lambda has no /dev/shm, so process pools do not work there
+        default = "thread" if os.getenv("AWS_LAMBDA_FUNCTION_NAME") else "process"
+        return os.getenv("RENDER_EXECUTOR", default)
+
+    @classmethod
+    def render_workers(cls) -> int:
+        return int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1))
+
+    @classmethod
+    def render_queue_size(cls) -> int:
+        # Posters waiting for a free worker
+        return int(os.getenv("RENDER_QUEUE_SIZE", 16))
+
+    @classmethod
+    def render_user_limit(cls) -> int:
+        # Posters rendered for one user at the same time
+        return int(os.getenv("RENDER_USER_LIMIT", 1))
+
 
 class DesignerSettings:
     @classmethod
@@ -80,6 +233,58 @@ class DesignerSettings:
         # A7 size 4.13 inh with 150 DPI
         return 620
 
+    @classmethod
+    def max_background_pixels(cls) -> int:
+        # Bigger backgrounds are rejected before decoding
+        return int(os.getenv("MAX_BACKGROUND_PIXELS", 100 * 1000 * 1000))
+
     @classmethod
     def max_font_size(cls) -> int:
         return 150
+
+    @classmethod
+    def quantize_flat_posters(cls) -> bool:
+        # Save posters without background photo with a palette: smaller files, slower encoding
+        return os.getenv("QUANTIZE_FLAT_POSTERS", "") == "1"
+
+    @classmethod
+    def font_cache_size(cls) -> int:
+        # Memory limit of loaded fonts cache in bytes
+        return int(os.getenv("FONT_CACHE_SIZE", 16 * 1024 * 1024))
+
+    @classmethod
+    def warm_fonts(cls) -> List[Tuple[str, int]]:
+        # Fonts loaded at start: fixed caption size and the most common quote sizes
+        return [(cls.path_to_caption_font(), cls.caption_fixed_font_size())] + [
+            (cls.path_to_font(), size) for size in (cls.max_font_size(), 120, 100, 80, 60)
+        ]
+
+    @classmethod
+    def measurement_cache_size(cls) -> int:
+        # Maximum number of cached text measurements and layouts
+        return int(os.getenv("MEASUREMENT_CACHE_SIZE", 50000))
+
+    @classmethod
+    def measurement_cache_ttl(cls) -> int:
+        return int(os.getenv("MEASUREMENT_CACHE_TTL", 60 * 60))  # in seconds
+
+    @classmethod
+    def render_cache_size(cls) -> int:
+        # Memory limit of rendered posters cache in bytes
+        return int(os.getenv("RENDER_CACHE_SIZE", 64 * 1024 * 1024))
+
+    @classmethod
+    def render_cache_dir(cls) -> Optional[str]:
+        # Directory of rendered posters disk cache. Disabled by default, /tmp on AWS Lambda
+        default = "/tmp/quote-bot/renders" if os.getenv("AWS_LAMBDA_FUNCTION_NAME") else None
+        return os.getenv("RENDER_CACHE_DIR", default)
+
+    @classmethod
+    def render_cache_disk_size(cls) -> int:
+        # Disk limit of rendered posters cache in bytes (AWS Lambda has 512 MB in /tmp)
+        return int(os.getenv("RENDER_CACHE_DISK_SIZE", 256 * 1024 * 1024))
+
+    @classmethod
+    def bundle_dir(cls) -> str:
+        # Templates, previews and font metrics prepared at build time (python -m quote_bot.bundle)
+        return os.getenv("BUNDLE_DIR", join(abspath(dirname(__file__)), "bundle"))
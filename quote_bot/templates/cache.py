@@ -0,0 +1,65 @@
+from hashlib import sha256
+from typing import Dict, Optional
+
+from quote_bot.cache import BoundedCache, DiskCache
+from quote_bot.settings import DesignerSettings
+
+
+class RenderCache:
+    """
+    Content-addressed cache of rendered posters: in-memory LRU tier and optional on-disk tier.
+    Each poster is stored once per output profile
+    """
+
+    def __init__(self):
+        self._memory = BoundedCache(DesignerSettings.render_cache_size(), weight=len)
+
+        path = DesignerSettings.render_cache_dir()
+        self._disk = DiskCache(path, DesignerSettings.render_cache_disk_size()) if path else None
+
+    @staticmethod
+    def key(
+        identifier: str,
+        version: str,
+        text: str,
+        caption: str,
+        background_id: Optional[str],
+        width: Optional[int] = None,
+    ) -> str:
+        """
+        Poster key
+        :param identifier: template identifier
+        :param version: template and fonts version, see TemplatesManager.version
+        :param text: normalized quote text
+        :param caption: normalized caption
+        :param background_id: unique ID of the background file (None for solid color background)
+        :param width: poster width (None for the template size)
+        :return: hex digest
+        """
+        digest = sha256()
+        parts = (identifier, version, text, caption, background_id or "") + ((str(width),) if width else ())
+        for part in parts:
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key: str, profile: str) -> Optional[bytes]:
+        key = f"{key}.{profile}"
+        image = self._memory.get(key)
+        if image is None and self._disk:
+            image = self._disk.get(key)
+            if image is not None:
+                self._memory.set(key, image)
+        return image
+
+    def set(self, key: str, profile: str, image: bytes):
+        key = f"{key}.{profile}"
+        self._memory.set(key, image)
+        if self._disk:
+            self._disk.set(key, image)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        stats = {"memory": self._memory.stats()}
+        if self._disk:
+            stats["disk"] = self._disk.stats()
+        return stats
@@ -1,18 +1,24 @@
 from copy import copy
 from enum import Enum
 from enum import auto as enum_auto
+from hashlib import sha256
 from io import BytesIO
 from os.path import dirname
 from os.path import join as join_path
 from os.path import realpath
-from typing import Dict, Optional, Tuple
+from typing import Dict, Optional, Sequence, Tuple
 
 from PIL import Image
 
-from quote_bot.designer import Align, add_background_on_image, add_text_on_image, compile_image, fill_color
+from quote_bot import metrics
+from quote_bot.bundle import Bundle, file_hash, load_bundle
+from quote_bot.cache import SingleFlight
+from quote_bot.designer import Align, add_background_on_image, add_text_on_image, compile_images, open_background
 from quote_bot.settings import DesignerSettings
 from quote_bot.textmanager import process as prepare_text
 
+from .cache import RenderCache
+
 
 class TemplateType(Enum):
     black = enum_auto()
@@ -20,21 +26,32 @@ class TemplateType(Enum):
 
 
 class Template:
-    def __init__(self, path: str, _type: TemplateType):
+    def __init__(self, path: str, _type: TemplateType, bundle: Optional[Bundle] = None):
         """
         Create image template
         :param path: path to .eps file
+        :param bundle: artifacts bundle to load the prepared layers and preview from
         """
         self._type = _type
         self._path = path
 
-        self._pil_image = Image.open(path)
+        artifacts = bundle.template(self.name, path, self.background_color) if bundle else None
+        if artifacts:
+            self._pil_image, self._filled_image, self._png_preview = artifacts
+        else:
+            # Layers ready to composite: the template itself and the template on its solid background
+            self._pil_image = Image.open(path).convert("RGBA")
+            self._filled_image = Image.new("RGB", self._pil_image.size, self.background_color)
+            self._filled_image.paste(self._pil_image, (0, 0), self._pil_image)
 
-        with BytesIO() as output:
-            preview = self.pil_image
-            preview.thumbnail((DesignerSettings.default_preview_width(), DesignerSettings.default_preview_width()))
-            preview.save(output, format="PNG")
-            self._png_preview = output.getvalue()
+            with BytesIO() as output:
+                preview = self.pil_image
+                preview.thumbnail((DesignerSettings.default_preview_width(), DesignerSettings.default_preview_width()))
+                preview.save(output, format="PNG")
+                self._png_preview = output.getvalue()
+        self._preview_id = sha256(self._png_preview).hexdigest()
+        self._version: Optional[str] = None
+        self._scaled_layers: Dict[int, Tuple[Image.Image, Image.Image]] = dict()
 
     @property
     def name(self) -> str:
@@ -52,10 +69,57 @@ class Template:
     def size(self):
         return self._pil_image.size
 
+    def scaled_size(self, width: Optional[int] = None) -> Tuple[int, int]:
+        """
+        Poster size
+        :param width: poster width (None for the template size)
+        """
+        if not width:
+            return self.size
+        return width, round(self._pil_image.height * width / self._pil_image.width)
+
+    def _layers(self, width: Optional[int] = None):
+        """
+        Template and template on its background scaled to the poster width (scaled once per width)
+        """
+        size = self.scaled_size(width)
+        if size == self.size:
+            return self._pil_image, self._filled_image
+        if width not in self._scaled_layers:
+            self._scaled_layers[width] = (
+                self._pil_image.resize(size, Image.LANCZOS, reducing_gap=3.0),
+                self._filled_image.resize(size, Image.LANCZOS, reducing_gap=3.0),
+            )
+        return self._scaled_layers[width]
+
+    def canvas(self, background=None, width: Optional[int] = None):
+        """
+        New image to draw the poster text on
+        :param background: background PIL Image of the poster size (solid background color if not provided)
+        :param width: poster width (None for the template size)
+        :return: PIL Image (RGB)
+        """
+        pil_image, filled_image = self._layers(width)
+        if background is None:
+            return filled_image.copy()
+        return add_background_on_image(pil_image, background)
+
     @property
     def preview(self) -> bytes:
         return copy(self._png_preview)
 
+    @property
+    def preview_id(self) -> str:
+        # Changes when the template file is replaced
+        return self._preview_id
+
+    @property
+    def version(self) -> str:
+        # Content hash of the template file: posters of a replaced template get new cache and file_id keys
+        if self._version is None:
+            self._version = file_hash(self._path)[:16]
+        return self._version
+
     @property
     def text_color(self) -> Tuple[int, int, int]:
         return {
@@ -75,35 +139,160 @@ class TemplatesManager:
     _path_to_templates: str = dirname(realpath(__file__))
     template_format: str = ".png"
 
-    def __init__(self):
+    def __init__(self, cache_renders: bool = True, bundle: bool = True):
+        """
+        Load templates
+        :param cache_renders: keep rendered posters in the render cache
+        :param bundle: load prepared templates from the artifacts bundle if it was built
+        """
+        artifacts = load_bundle() if bundle else None
         self._templates = {
-            "black": Template(join_path(self._path_to_templates, "black.png"), TemplateType.black),
-            "white": Template(join_path(self._path_to_templates, "white.png"), TemplateType.white),
+            "black": Template(join_path(self._path_to_templates, "black.png"), TemplateType.black, artifacts),
+            "white": Template(join_path(self._path_to_templates, "white.png"), TemplateType.white, artifacts),
         }
+        self.render_cache = RenderCache() if cache_renders else None
+        self._in_flight = SingleFlight()
+        self._fonts_version: Optional[str] = None
+        if self.render_cache:
+            metrics.registry.register_stats("render", self.render_cache.stats)
 
     def all_templates(self) -> Dict[str, Template]:
         return self._templates
 
-    def process_template(self, identifier: str, text: str, background: Optional[BytesIO] = None) -> bytes:
-        template = self._templates[identifier]
-
+    @staticmethod
+    def split_text(text: str) -> Tuple[str, str]:
+        """
+        Split user text to the quote and the caption and normalize them
+        :param text: user text in format 'Text @ Author'
+        :return: Tuple[quote text, caption]
+        """
         if "@" in text:
             text, caption = text.split("@", maxsplit=1)
         else:
             caption = ""
-        text = prepare_text(text)
-        caption = prepare_text(caption)
+        return prepare_text(text), prepare_text(caption)
 
-        pil_image = add_text_on_image(
-            template.pil_image,
+    def version(self, identifier: str) -> str:
+        """
+        Version of the template and the fonts (content hashes of the files)
+        :param identifier: template identifier
+        """
+        if self._fonts_version is None:
+            fonts = (DesignerSettings.path_to_font(), DesignerSettings.path_to_caption_font())
+            self._fonts_version = sha256("".join(file_hash(path) for path in fonts).encode()).hexdigest()[:16]
+        return f"{self._templates[identifier].version}.{self._fonts_version}"
+
+    def render_key(
+        self, identifier: str, text: str, background_id: Optional[str] = None, width: Optional[int] = None
+    ) -> str:
+        """
+        Render cache key of the poster
+        :param identifier: template identifier
+        :param text: user text
+        :param background_id: unique ID of the background file
+        :param width: poster width (None for the template size)
+        """
+        return RenderCache.key(identifier, self.version(identifier), *self.split_text(text), background_id, width)
+
+    def process_template(
+        self,
+        identifier: str,
+        text: str,
+        background: Optional[BytesIO] = None,
+        background_id: Optional[str] = None,
+        profile: str = "png",
+        width: Optional[int] = None,
+    ) -> bytes:
+        """
+        Render poster
+        :param identifier: template identifier
+        :param text: user text
+        :param background: background image file
+        :param background_id: unique ID of the background file. Posters with unknown background are not cached
+        :param profile: output profile, see designer.OUTPUT_PROFILES
+        :param width: poster width, e.g. DesignerSettings.default_preview_width() (None for the template size)
+        :return: encoded image
+        """
+        return self.render(identifier, text, background, background_id, (profile,), width)[profile]
+
+    def render(
+        self,
+        identifier: str,
+        text: str,
+        background: Optional[BytesIO] = None,
+        background_id: Optional[str] = None,
+        profiles: Sequence[str] = ("png",),
+        width: Optional[int] = None,
+        key: Optional[str] = None,
+    ) -> Dict[str, bytes]:
+        """
+        Render poster and encode it with several output profiles.
+        Smaller posters have the same layout as the full size poster, scaled down
+        :param key: render cache key (see render_key) if the caller has looked the poster up in the cache already
+        :return: Dict[profile name, encoded image]
+        :raise BadBackground: background is not an image
+        :raise BackgroundTooLarge: background has too many pixels
+        """
+        template = self._templates[identifier]
+        text, caption = self.split_text(text)
+        if background is not None and not background_id:  # Unknown background: poster can not be shared
+            return self._render(template, text, caption, background, profiles, width)
+
+        lookup = key is None  # Otherwise the caller has looked the poster up already
+        if key is None:
+            key = RenderCache.key(identifier, self.version(identifier), text, caption, background_id, width)
+        if lookup and self.render_cache:
+            images = {profile: self.render_cache.get(key, profile) for profile in profiles}
+            if None not in images.values():
+                metrics.count("render_cache_hits")
+                return images
+
+        # The same poster requested by several users at once is rendered once
+        images, shared = self._in_flight.do(
+            (key, tuple(profiles)), lambda: self._render(template, text, caption, background, profiles, width)
+        )
+        if shared:
+            metrics.count("renders_coalesced")
+        elif self.render_cache:
+            for profile, image in images.items():
+                self.render_cache.set(key, profile, image)
+        return dict(images)
+
+    def warm_up(self, text: str = "Прогрев @ Автор"):
+        """
+        Render a poster the way the bot sends it: the preview photo and the full size document.
+        Loads layers, fonts and the morphology dictionary. The posters are not kept in the render cache
+        """
+        template = next(iter(self._templates.values()))
+        quote, caption = self.split_text(text)
+        self._render(template, quote, caption, None, ("photo",), DesignerSettings.default_preview_width())
+        self._render(template, quote, caption, None, ("document",), None)
+
+    def _render(
+        self,
+        template: Template,
+        text: str,
+        caption: str,
+        background: Optional[BytesIO],
+        profiles: Sequence[str],
+        width: Optional[int],
+    ) -> Dict[str, bytes]:
+        # Text is drawn right on the output image: no intermediate full-size layers
+        background = open_background(background, template.scaled_size(width)) if background else None
+        with metrics.stage("composite"):
+            pil_image = template.canvas(background, width)
+
+        add_text_on_image(
+            pil_image,
             text,
             template.text_color,
             DesignerSettings.text_position(),
             path_to_font=DesignerSettings.path_to_font(),
+            layout_size=template.size,
         )
 
         if caption:
-            pil_image = add_text_on_image(
+            add_text_on_image(
                 pil_image,
                 caption,
                 template.text_color,
@@ -111,11 +300,7 @@ class TemplatesManager:
                 align=Align.left,
                 path_to_font=DesignerSettings.path_to_caption_font(),
                 fixed_font_size=DesignerSettings.caption_fixed_font_size(),
+                layout_size=template.size,
             )
 
-        if background:
-            pil_image = add_background_on_image(pil_image, Image.open(background))
-        else:
-            pil_image = fill_color(pil_image, template.background_color)
-
-        return compile_image(pil_image)
+        return compile_images(pil_image, profiles, flat=background is None)
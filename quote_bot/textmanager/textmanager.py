@@ -1,7 +1,8 @@
 import re
 from abc import ABC, abstractmethod
+from functools import lru_cache
 
-import pymorphy2
+from quote_bot import metrics
 
 
 class TextFilter(ABC):
@@ -37,28 +38,63 @@ class FilterBadHyphen(TextFilter):
 
 
 class FilterHangingPreposition(TextFilter):
-    analyzer = pymorphy2.MorphAnalyzer()
+    # Short prepositions and conjunctions recognized without pymorphy2
+    # fmt: off
+    common_words = frozenset((
+        "в", "во", "на", "с", "со", "к", "ко", "о", "об", "обо", "от", "у", "из", "за", "по", "до", "для", "без",
+        "под", "над", "при", "про", "через", "перед", "между", "среди", "из-за", "из-под",
+        "и", "а", "но", "или", "либо", "если", "чтобы", "хотя", "зато",
+    ))
+    # fmt: on
+    max_length = 5  # Longer words (except common_words) never hang
+    _analyzer = None
+    _tokens = re.compile(r"(\s)")
+
+    @classmethod
+    def analyzer(cls):
+        """
+        Morphological analyzer. Loading dictionaries takes time and memory, so it is loaded on first use
+        """
+        if cls._analyzer is None:
+            import pymorphy2
+
+            cls._analyzer = pymorphy2.MorphAnalyzer()
+        return cls._analyzer
+
+    @classmethod
+    @lru_cache(maxsize=10000)
+    def is_hanging(cls, word: str) -> bool:
+        """
+        Word is a short preposition or conjunction
+        Cached function
+        """
+        if word.lower() in cls.common_words:
+            return True
+        if len(word) > cls.max_length:
+            return False
+        return cls.analyzer().parse(word)[0].tag.POS in ("PREP", "CONJ")
 
     @classmethod
     def process(cls, text_in: str) -> str:
         """
         Place non-breaking spaces after prepositions, conjunctions
         Example: 'привет и пока' -> 'привет и\xa0пока'
-        Example: 'из-за двери перекати-поле' -> 'из\u2011за двери перекати-поле'
+        Example: 'из-за двери перекати-поле' -> 'из\u2011за\xa0двери перекати-поле'
         """
-        text = text_in
-        words = text.split()
-        for word in words:
-            if cls.analyzer.parse(word)[0].tag.POS in ("PREP", "CONJ") and len(word) < 6:
-                text = text.replace(" " + word + " ", " " + word + "\u00a0")  # non-breaking space
+        tokens = cls._tokens.split(text_in)  # words and whitespaces one by one
+        for i in range(0, len(tokens) - 2, 2):
+            word = tokens[i]
+            if tokens[i + 1] == " " and tokens[i + 2] and word and cls.is_hanging(word):
+                tokens[i + 1] = "\u00a0"  # non-breaking space
                 if "-" in word:
-                    text = text.replace(word, word.replace("-", "\u2011"))  # non-breaking hyphen
-        return text
+                    tokens[i] = word.replace("-", "\u2011")  # non-breaking hyphen
+        return "".join(tokens)
 
 
 def process(text_in: str) -> str:
     text = text_in
-    for kls in TextFilter.__subclasses__():
-        text = kls.process(text)
+    with metrics.stage("text"):
+        for kls in TextFilter.__subclasses__():
+            text = kls.process(text)
 
     return text
@@ -1,20 +1,74 @@
+from hashlib import sha256
 from io import BytesIO
-from typing import Optional
+from typing import Dict, Optional
 
-from aiocache import cached
 from aiogram import Bot
 
+from quote_bot import metrics
+from quote_bot.cache import BoundedCache, DiskCache
+from quote_bot.settings import BotSettings
 
-@cached()
-async def download_file(file_id: Optional[str] = None) -> Optional[BytesIO]:
+
+class BackgroundCache:
+    """
+    Downloaded background files: in-memory LRU tier (bounded by size and age) and optional on-disk tier.
+    Files are stored as immutable bytes, every reader gets its own stream
+    """
+
+    def __init__(self):
+        self._memory = BoundedCache(
+            BotSettings.background_cache_size(), weight=len, ttl=BotSettings.background_cache_ttl()
+        )
+
+        path = BotSettings.background_cache_dir()
+        self._disk = DiskCache(path, BotSettings.background_cache_disk_size()) if path else None
+
+    @staticmethod
+    def _disk_key(key: str) -> str:
+        return sha256(key.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        content = self._memory.get(key)
+        if content is None and self._disk:
+            content = self._disk.get(self._disk_key(key))
+            if content is not None:
+                self._memory.set(key, content)
+        return content
+
+    def set(self, key: str, content: bytes):
+        self._memory.set(key, content)
+        if self._disk:
+            self._disk.set(self._disk_key(key), content)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        stats = {"memory": self._memory.stats()}
+        if self._disk:
+            stats["disk"] = self._disk.stats()
+        return stats
+
+
+background_cache = BackgroundCache()
+metrics.registry.register_stats("background", background_cache.stats)
+
+
+async def download_file(file_id: Optional[str] = None, file_unique_id: Optional[str] = None) -> Optional[BytesIO]:
     """
     Download file from Telegram server by ID
-    Cached function
+    Cached function: see background_cache
+    :param file_id: file ID to download the file
+    :param file_unique_id: unique file ID (the same for all bots), used as the cache key if provided
+    :return: new stream for every call
     """
     if not file_id:
         return None
 
-    stream = BytesIO()
-    bot = Bot.get_current()
-    await bot.download_file_by_id(file_id, stream)
-    return stream
+    key = file_unique_id or file_id
+    content = background_cache.get(key)
+    if content is None:
+        stream = BytesIO()
+        bot = Bot.get_current()
+        with metrics.stage("download"):
+            await bot.download_file_by_id(file_id, stream)
+        content = stream.getvalue()
+        background_cache.set(key, content)
+    return BytesIO(content)
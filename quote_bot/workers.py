@@ -0,0 +1,185 @@
+from asyncio import get_event_loop
+from collections import Counter
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import copy_context
+from functools import partial
+from io import BytesIO
+from typing import TYPE_CHECKING, Dict, Optional, Sequence, Tuple
+
+from quote_bot import metrics
+from quote_bot.cache import AsyncSingleFlight
+from quote_bot.settings import BotSettings
+
+if TYPE_CHECKING:
+    from quote_bot.templates import TemplatesManager
+
+
+class RenderPoolBusy(Exception):
+    """
+    Too many posters are queued for rendering
+    """
+
+
+class UserRenderLimit(Exception):
+    """
+    User already has too many posters in rendering
+    """
+
+
+_process_templates_manager: Optional["TemplatesManager"] = None
+
+
+def _render_in_process(
+    identifier: str, text: str, background: Optional[bytes], profiles: Sequence[str], width: Optional[int]
+) -> Tuple[Dict[str, bytes], Dict]:
+    """
+    Render poster in a worker process (each process has its own templates manager)
+    :return: Tuple[Dict[profile name, encoded image], render stages and counters]
+    """
+    global _process_templates_manager
+    if _process_templates_manager is None:
+        from quote_bot.templates import TemplatesManager
+
+        _process_templates_manager = TemplatesManager(cache_renders=False)
+    background = BytesIO(background) if background else None
+    with metrics.collect() as trace:
+        images = _process_templates_manager.render(identifier, text, background, profiles=profiles, width=width)
+    return images, trace.to_dict()
+
+
+class RenderPool:
+    """
+    Render posters out of the event loop: in a process pool (polling on a server) or a thread pool (AWS Lambda)
+    """
+
+    def __init__(self, templates_manager: "TemplatesManager", executor_type: str, workers: int):
+        """
+        Create render pool. Workers are started on the first render
+        :param templates_manager: templates manager (used by the thread pool)
+        :param executor_type: "process" or "thread"
+        :param workers: number of workers
+        """
+        if executor_type not in ("process", "thread"):
+            raise ValueError(f"Unknown render executor {executor_type}")
+
+        self._templates_manager = templates_manager
+        self._executor_type = executor_type
+        self._workers = workers
+        self._executor: Optional[Executor] = None
+        self._in_flight = AsyncSingleFlight()
+
+        self._queue_size = BotSettings.render_queue_size()
+        self._user_limit = BotSettings.render_user_limit()
+        self._pending = 0
+        self._users = Counter()
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self._executor_type == "process":
+                self._executor = ProcessPoolExecutor(self._workers)
+            else:
+                self._executor = ThreadPoolExecutor(self._workers)
+        return self._executor
+
+    @contextmanager
+    def reserve(self, user_id: int):
+        """
+        Reserve place in the render queue for the user
+        :param user_id: Telegram user id
+        :raise RenderPoolBusy: queue is full
+        :raise UserRenderLimit: user renders too many posters at once
+        """
+        if self._users[user_id] >= self._user_limit:
+            raise UserRenderLimit()
+        if self._pending >= self._workers + self._queue_size:
+            raise RenderPoolBusy()
+
+        self._pending += 1
+        self._users[user_id] += 1
+        try:
+            yield
+        finally:
+            self._pending -= 1
+            self._users[user_id] -= 1
+            if not self._users[user_id]:
+                del self._users[user_id]
+
+    async def render_key(
+        self, identifier: str, text: str, background_id: Optional[str] = None, width: Optional[int] = None
+    ) -> str:
+        """
+        Render cache key of the poster, see TemplatesManager.render_key.
+        Text is normalized (with pymorphy2) out of the event loop
+        """
+        return await get_event_loop().run_in_executor(
+            None, self._templates_manager.render_key, identifier, text, background_id, width
+        )
+
+    async def render(
+        self,
+        identifier: str,
+        text: str,
+        background: Optional[BytesIO] = None,
+        background_id: Optional[str] = None,
+        profiles: Sequence[str] = ("png",),
+        width: Optional[int] = None,
+        key: Optional[str] = None,
+    ) -> Dict[str, bytes]:
+        """
+        Render poster in the pool and save it to the render cache, see TemplatesManager.render.
+        The same poster requested by several users at once is rendered once, the rest await it
+        :param key: render cache key (see render_key), the caller has looked the poster up in the cache already.
+        None if the poster is not shared (unknown background)
+        """
+        if key is None:
+            return await self._render(identifier, text, background, background_id, profiles, width)
+
+        images, shared = await self._in_flight.do(
+            (key, tuple(profiles)),
+            lambda: self._render(identifier, text, background, background_id, profiles, width, key),
+        )
+        if shared:
+            metrics.count("renders_coalesced")
+        return dict(images)
+
+    async def _render(
+        self,
+        identifier: str,
+        text: str,
+        background: Optional[BytesIO],
+        background_id: Optional[str],
+        profiles: Sequence[str],
+        width: Optional[int],
+        key: Optional[str] = None,
+    ) -> Dict[str, bytes]:
+        """
+        :param key: render cache key (None if the poster is not cached)
+        """
+        loop = get_event_loop()
+        if self._executor_type == "thread":
+            # Render stages are recorded in the trace of the caller
+            render = partial(copy_context().run, self._templates_manager.render)
+            with metrics.stage("render"):
+                return await loop.run_in_executor(
+                    self.executor, render, identifier, text, background, background_id, profiles, width, key
+                )
+
+        # Worker processes do not cache posters, the main process does it for them
+        cache = self._templates_manager.render_cache if key else None
+        background = background.getvalue() if background else None
+        with metrics.stage("render"):
+            images, trace = await loop.run_in_executor(
+                self.executor, _render_in_process, identifier, text, background, profiles, width
+            )
+        metrics.merge(trace)
+        if cache:
+            for profile, image in images.items():
+                cache.set(key, profile, image)
+        return images
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None